@@ -3,11 +3,21 @@
 from __future__ import annotations
 
 import argparse
+import calendar
 import datetime
+import hashlib
+import json
 import sys
 from collections.abc import Sequence
 
+from sql_console.fanout import EnvironmentResult, failed, fan_out, parse_environments, report, source_groups
+from sql_console.ledger import JobRun, add_ledger_arguments, run_from_args
+from sql_console.memory import MemoryBudgetExceeded, MemoryMonitor, add_memory_arguments, monitor_from_args
+from sql_console.profiling import add_profile_arguments, profile_from_args
+from sql_console.snapshot import SnapshotReader, cursor_columns, write_snapshot
 from sql_console.sql_console import SqlWrapper, SqlWrapperConnectionError
+from sql_console.state import LoadStateStore
+from sql_console.timeouts import add_timeout_arguments, timeout_params
 
 
 def parse_process_date(value: str) -> datetime.date:
@@ -44,8 +54,12 @@ def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
         "--environment",
         dest="environment",
         type=str,
+        nargs="+",
         required=True,
-        help="Target environment (dev, uat, prd).",
+        help=(
+            "Target environment(s) (uat, prd).  With several, Apollo is read"
+            " once per Apollo host and the environments are loaded concurrently."
+        ),
     )
     parser.add_argument(
         "--postgres-username",
@@ -61,18 +75,85 @@ def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
         required=True,
         help="Postgres password.",
     )
-
-    return parser.parse_args(argv)
-
-
-def determine_constant_name(process_date: datetime.date) -> str | None:
+    parser.add_argument(
+        "--snapshot-out",
+        dest="snapshot_out",
+        type=str,
+        default=None,
+        help="Write the SLO configuration read from Apollo to this snapshot file.",
+    )
+    parser.add_argument(
+        "--replay",
+        dest="replay",
+        type=str,
+        default=None,
+        help="Read the SLO configuration from this snapshot file instead of Apollo.",
+    )
+    parser.add_argument(
+        "--schedule-months",
+        dest="schedule_months",
+        type=int,
+        default=None,
+        help=(
+            "Generate the SLO schedule for this many months from --process-date"
+            " instead of a single day.  Only days whose SLOs changed are rewritten."
+        ),
+    )
+    parser.add_argument(
+        "--holiday-file",
+        dest="holiday_file",
+        type=str,
+        default=None,
+        help="Business holidays, one YYYY-MM-DD per line ('#' starts a comment); no SLOs are scheduled on them.",
+    )
+    parser.add_argument(
+        "--state-file",
+        dest="state_file",
+        type=str,
+        default=None,
+        help="SQLite file caching ConstantValueLookup and the fingerprint of every scheduled day.",
+    )
+    parser.add_argument(
+        "--refresh-constants",
+        dest="refresh_constants",
+        action="store_true",
+        help="Read ConstantValueLookup from Apollo even when the state file has a cached copy.",
+    )
+    parser.add_argument(
+        "--constants-max-age",
+        dest="constants_max_age",
+        type=float,
+        default=24.0,
+        help="Hours a cached copy of ConstantValueLookup is used before it is read from Apollo again (default 24).",
+    )
+    add_timeout_arguments(parser)
+    add_memory_arguments(parser, soft_limit=False)
+    add_ledger_arguments(parser)
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.schedule_months is not None:
+        if args.schedule_months < 1:
+            parser.error("--schedule-months must be at least 1")
+        if args.replay or args.snapshot_out:
+            parser.error("--replay and --snapshot-out only apply to single-day runs")
+    return args
+
+
+def determine_constant_name(
+    process_date: datetime.date, holidays: frozenset[datetime.date] = frozenset()
+) -> str | None:
     """Return the ConstantValueLookup key for ``process_date``.
 
     The legacy "Scott method" determines which constant name should be used for
-    the calculated day.  Only weekdays are eligible for SLOs; weekends return
-    ``None`` to indicate that no insert should occur.
+    the calculated day.  Only weekdays that are not business holidays are
+    eligible for SLOs; other days return ``None`` to indicate that no insert
+    should occur.
     """
 
+    if process_date in holidays:
+        return None
+
     weekday = process_date.weekday()
 
     if weekday == 4:  # Friday
@@ -86,6 +167,75 @@ def determine_constant_name(process_date: datetime.date) -> str | None:
     return None
 
 
+def load_holidays(path: str | None) -> frozenset[datetime.date]:
+    """Return the business holidays listed in the file at ``path``."""
+
+    holidays: set[datetime.date] = set()
+    if path is None:
+        return frozenset()
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                holidays.add(datetime.date.fromisoformat(line.split()[0]))
+    return frozenset(holidays)
+
+
+def add_months(day: datetime.date, months: int) -> datetime.date:
+    """Return ``day`` moved ``months`` months ahead, clamped to the month end."""
+
+    month = day.month - 1 + months
+    year = day.year + month // 12
+    month = month % 12 + 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def schedule_days(process_date: datetime.date, months: int | None) -> list[datetime.date]:
+    """Return the process dates to schedule, starting at ``process_date``."""
+
+    if months is None:
+        return [process_date]
+    count = (add_months(process_date, months) - process_date).days
+    return [process_date + datetime.timedelta(days=offset) for offset in range(count)]
+
+
+def slo_schedule(
+    days: Sequence[datetime.date],
+    holidays: frozenset[datetime.date],
+    constants: dict[str, list[str]],
+) -> dict[datetime.date, list[str]]:
+    """Return the SLO timestamps of every process date in ``days``.
+
+    ``constants`` maps each ConstantValueLookup name to its SLO times.  The
+    SLOs of a process date fall on the following day; weekends and holidays
+    get none.
+    """
+
+    one_day = datetime.timedelta(days=1)
+    return {
+        day: [
+            f"{(day + one_day).isoformat()} {slo_time}"
+            for slo_time in constants.get(determine_constant_name(day, holidays) or "", ())
+        ]
+        for day in days
+    }
+
+
+def fingerprint(slos: list[str]) -> str:
+    """Return the fingerprint of one day's SLOs, stored to detect changes."""
+
+    return hashlib.sha1(json.dumps(slos).encode("utf-8")).hexdigest()
+
+
+def constant_query(constant_name: str) -> str:
+    return (
+        "select * from ConstantValueLookup "
+        "where ApplicationName='batch_slo' "
+        f"and ConstantName='{constant_name}'"
+    )
+
+
 def coerce_slo_time(value: object) -> str:
     """Convert ``value`` returned from the database into a time string."""
 
@@ -100,18 +250,71 @@ def escape_sql_literal(value: str) -> str:
     return value.replace("'", "''")
 
 
+def write_slo_snapshot(
+    path: str,
+    slos: list,
+    apollo: SqlWrapper,
+    constant_query: str,
+    constant_name: str,
+    process_date: datetime.date,
+) -> None:
+    """Write the SLO configuration rows read from Apollo to ``path``."""
+
+    width = len(slos[0]) if slos else 1
+    metadata = {
+        "job": "calculate_slos",
+        "query": constant_query,
+        "parameters": {"constant_name": constant_name, "process_date": process_date.isoformat()},
+        "origin": "apollo",
+    }
+    count = write_snapshot(path, slos, cursor_columns(apollo.cursor.description, width), metadata)
+    print(f"calculate_slos.py: info: wrote {count} SLO rows to snapshot {path}")
+
+
+def read_slo_snapshot(path: str, constant_query: str) -> list | bool:
+    """Return the SLO configuration rows recorded in the snapshot at ``path``.
+
+    The snapshot must have been taken for the same constant; replaying the
+    configuration of another day type would insert the wrong SLOs.
+    """
+
+    with SnapshotReader(path) as snapshot:
+        if snapshot.metadata.get("query") != constant_query:
+            print(
+                f"calculate_slos.py: error: snapshot {path} was taken for a"
+                " different SLO configuration query."
+            )
+            return False
+        print(
+            f"calculate_slos.py: info: replaying SLO configuration from {path}"
+            f" taken at {snapshot.metadata.get('created_at')}"
+        )
+        return list(snapshot)
+
+
+def batch_config(environment: str, username: str, password: str) -> dict:
+    """Return the :class:`SqlWrapper` parameters of the batch database."""
+
+    return {
+        "env": environment,
+        "method": "psycopg2",
+        "server": f"pg{environment}",
+        "db": "batch",
+        "credentials": {"user": username, "password": password},
+        "debug": True,
+        "format": "json",
+    }
+
+
 def main(argv: Sequence[str] | None = None) -> int:
     """Program entry point."""
 
     args = parse_args(argv)
-
+    monitor = monitor_from_args("calculate_slos.py", args)
+    environments = parse_environments(args.environment)
     process_date: datetime.date = args.process_date
-    environment = args.environment.lower()
-    username = args.username
-    password = args.password
 
-    constant_name = determine_constant_name(process_date)
-    if constant_name is None:
+    if args.schedule_months is None and determine_constant_name(process_date) is None:
         print(
             "calculate_slos.py: error: the provided process_date"
             f" {process_date.isoformat()} falls on a weekend or does not have"
@@ -119,114 +322,305 @@ def main(argv: Sequence[str] | None = None) -> int:
         )
         return 1
 
-    slo_date = process_date + datetime.timedelta(days=1)
-
     try:
-        apollo = SqlWrapper(
-            {
-                "env": environment,
-                "method": "pyodbc",
-                "server": "apollo",
-                "db": "worldwide",
-                "debug": True,
-                "format": "json",
-            }
-        )
-        batch = SqlWrapper(
-            {
-                "env": environment,
-                "method": "psycopg2",
-                "server": f"pg{environment}",
-                "db": "batch",
-                "credentials": {"user": username, "password": password},
-                "debug": True,
-                "format": "json",
-            }
+        holidays = load_holidays(args.holiday_file)
+    except (OSError, ValueError) as exc:
+        print(f"calculate_slos.py: error: could not read holiday file: {exc}")
+        return 1
+    days = schedule_days(process_date, args.schedule_months)
+    state = LoadStateStore(args.state_file) if args.state_file else None
+
+    job_runs = {
+        environment: run_from_args(
+            "calculate_slos", args, batch_config(environment, args.username, args.password), monitor
         )
+        for environment in environments
+    }
+    for job_run in job_runs.values():
+        job_run.start()
+
+    # environments reading the same Apollo host share one read
+    groups = {"replay": environments} if args.replay else source_groups(environments, "apollo")
+    results: dict[str, EnvironmentResult] = {}
+    try:
+        with profile_from_args("calculate_slos.py", args):
+            for source, group in groups.items():
+                try:
+                    results.update(
+                        populate_slos(args, source, group, days, holidays, state, monitor, job_runs, len(groups) > 1)
+                    )
+                except MemoryBudgetExceeded as exc:
+                    print(str(exc))
+                    break
+                except Exception as exc:  # pragma: no cover - defensive logging
+                    print(f"calculate_slos.py: error: unexpected failure: {exc}")
+                    results.update(failed(group, str(exc)))
+
+        for environment in environments:
+            results.setdefault(environment, EnvironmentResult(environment, 1, 0.0, "not loaded"))
+    finally:
+        for environment, job_run in job_runs.items():
+            result = results.get(environment)
+            job_run.finish(result.exit_code if result else 1, result.error if result else None)
+        if state is not None:
+            state.close()
+        if args.memory_report:
+            monitor.report()
+
+    return report("calculate_slos.py", results) if len(environments) > 1 else results[environments[0]].exit_code
+
+
+def connect(server: str, environment: str, args: argparse.Namespace) -> SqlWrapper | None:
+    """Return a connection to ``server``, or ``None`` after reporting why not."""
+
+    try:
+        if server == "apollo":
+            return SqlWrapper(
+                {
+                    "env": environment,
+                    "method": "pyodbc",
+                    "server": "apollo",
+                    "db": "worldwide",
+                    "debug": True,
+                    "format": "json",
+                    "admission": True,
+                    **timeout_params(args),
+                }
+            )
+        return SqlWrapper({**batch_config(environment, args.username, args.password), **timeout_params(args)})
     except ModuleNotFoundError as exc:
         print(
             "calculate_slos.py: error: required database driver"
             f" '{exc.name}' is not installed for Python {sys.version.split()[0]}."
         )
-        return 1
     except SqlWrapperConnectionError as exc:
         print(f"calculate_slos.py: error: {exc}")
-        return 1
-
-    try:
-        constant_query = (
-            "select * from ConstantValueLookup "
-            "where ApplicationName='batch_slo' "
-            f"and ConstantName='{constant_name}'"
-        )
-        slos = apollo.query({"query": constant_query, "results": True})
+    return None
 
-        if slos is False:
-            print(
-                "calculate_slos.py: error: failed to fetch SLO configuration"
-                " from Apollo."
-            )
-            return 1
 
+def close(connection: SqlWrapper) -> None:
+    try:
+        connection.close()
+    except Exception:  # pragma: no cover - best effort cleanup
+        pass
+
+
+def snapshot_path(path: str, environment: str, per_environment: bool) -> str:
+    """Return where to write the snapshot of the read for ``environment``."""
+
+    if not per_environment:
+        return path
+    stem, dot, suffix = path.rpartition(".")
+    return f"{stem}.{environment}.{suffix}" if dot else f"{path}.{environment}"
+
+
+def read_constants(
+    args: argparse.Namespace,
+    environment: str,
+    constant_names: list[str],
+    per_environment_snapshot: bool,
+) -> dict[str, list[str]] | None:
+    """Read the SLO times of ``constant_names`` from Apollo or the --replay snapshot."""
+
+    if args.replay is not None:
+        # single-day runs only, so there is one constant at most
+        constants = {}
+        for constant_name in constant_names:
+            slos = read_slo_snapshot(args.replay, constant_query(constant_name))
+            if slos is False:
+                return None
+            constants[constant_name] = slos
+    else:
+        apollo = connect("apollo", environment, args)
+        if apollo is None:
+            return None
+
+        constants = {}
+        try:
+            for constant_name in constant_names:
+                slos = apollo.query({"query": constant_query(constant_name), "results": True})
+                if slos is False:
+                    print(
+                        "calculate_slos.py: error: failed to fetch SLO configuration"
+                        " from Apollo."
+                    )
+                    return None
+                if args.snapshot_out:
+                    write_slo_snapshot(
+                        snapshot_path(args.snapshot_out, environment, per_environment_snapshot),
+                        slos,
+                        apollo,
+                        constant_query(constant_name),
+                        constant_name,
+                        args.process_date,
+                    )
+                constants[constant_name] = slos
+        finally:
+            close(apollo)
+
+    for constant_name, slos in constants.items():
         if not slos:
             print(
                 "calculate_slos.py: error: no SLO configuration found for"
                 f" constant '{constant_name}'."
             )
-            return 1
-
-        process_date_sql = escape_sql_literal(process_date.isoformat())
-        inserted_rows = 0
-
-        for row in slos:
-            if len(row) <= 3:
-                print(
-                    "calculate_slos.py: error: unexpected row format returned"
-                    " from Apollo."
-                )
-                return 1
+            return None
+        if any(len(row) <= 3 for row in slos):
+            print(
+                "calculate_slos.py: error: unexpected row format returned"
+                " from Apollo."
+            )
+            return None
+
+    return {
+        constant_name: [coerce_slo_time(row[3]).strip() for row in slos]
+        for constant_name, slos in constants.items()
+    }
+
+
+def populate_slos(
+    args: argparse.Namespace,
+    source: str,
+    environments: list[str],
+    days: list[datetime.date],
+    holidays: frozenset[datetime.date],
+    state: LoadStateStore | None,
+    monitor: MemoryMonitor,
+    job_runs: dict[str, JobRun],
+    per_environment_snapshot: bool = False,
+) -> dict[str, EnvironmentResult]:
+    """Schedule the SLOs of ``days`` in each of ``environments``.
+
+    The ConstantValueLookup rows are read once from the ``source`` Apollo
+    host, or on single-day runs from the state file cache while it is younger
+    than ``--constants-max-age``, and only the days whose SLOs differ from the
+    fingerprint committed for an environment are rewritten.
+    """
 
-            slo_timestamp = (
-                f"{slo_date.isoformat()} {coerce_slo_time(row[3]).strip()}"
+    source_environment = environments[0]
+    constant_names = sorted({name for name in (determine_constant_name(day, holidays) for day in days) if name})
+    # one cache entry per constant, so each one ages on its own
+    cache_keys = {name: f"calculate_slos:constants:{source}:{name}" for name in constant_names}
+    max_age = args.constants_max_age * 3600
+
+    constants: dict[str, list[str]] | None = {} if not constant_names else None
+    with monitor.stage("fetch"):
+        if constants is None and state is not None and args.schedule_months is None and not (
+            args.refresh_constants or args.replay or args.snapshot_out
+        ):
+            cached = {name: state.cached(key, max_age) for name, key in cache_keys.items()}
+            if all(slos is not None for slos in cached.values()):
+                constants = cached
+
+        if constants is None:
+            constants = read_constants(args, source_environment, constant_names, per_environment_snapshot)
+            if constants is None:
+                return failed(environments, "failed to fetch SLO configuration")
+            for environment in environments:
+                job_runs[environment].add(rows_read=sum(len(times) for times in constants.values()))
+            if state is not None and args.replay is None:
+                for name, slos in constants.items():
+                    state.cache(cache_keys[name], slos)
+
+    with monitor.stage("transform"):
+        schedule = slo_schedule(days, holidays, constants)
+        fingerprints = {day.isoformat(): fingerprint(slos) for day, slos in schedule.items()}
+
+        changed: dict[str, list[datetime.date]] = {}
+        for environment in environments:
+            committed = (
+                state.fingerprints(f"calculate_slos:{environment}", days[0].isoformat(), days[-1].isoformat())
+                if state is not None
+                else {}
+            )
+            changed[environment] = [
+                day for day in days if committed.get(day.isoformat()) != fingerprints[day.isoformat()]
+            ]
+            if not changed[environment]:
+                print(f"calculate_slos.py: info: {environment}: SLOs already scheduled through {days[-1].isoformat()}")
+
+    results: dict[str, EnvironmentResult] = {}
+    pending = [environment for environment in environments if changed[environment]]
+    if pending:
+        with monitor.stage("write"):
+            results = fan_out(
+                pending,
+                lambda environment: write_schedule(
+                    args, environment, changed[environment], schedule, job_runs[environment]
+                ),
             )
-            slo_timestamp_sql = escape_sql_literal(slo_timestamp)
 
-            insert_query = (
-                "INSERT INTO batch.slos (process_date, slo) "
-                f"VALUES ('{process_date_sql}', '{slo_timestamp_sql}')"
+    for environment in environments:
+        result = results.setdefault(environment, EnvironmentResult(environment, 0))
+        if state is not None and result.exit_code == 0 and changed[environment]:
+            state.commit_fingerprints(
+                f"calculate_slos:{environment}",
+                {day.isoformat(): fingerprints[day.isoformat()] for day in changed[environment]},
             )
-            result = batch.query({"query": insert_query, "results": False})
+    return results
 
-            if result is not True:
-                print(
-                    "calculate_slos.py: error: INSERT query failed with state: "
-                    f"{result}"
-                )
-                return 1
 
-            inserted_rows += 1
+SCHEDULE_CHUNK_DAYS = 100
 
-        if inserted_rows == 0:
-            print(
-                "calculate_slos.py: warning: no SLO rows were inserted."
-            )
 
-        return 0
+def schedule_statement(days: Sequence[datetime.date], schedule: dict[datetime.date, list[str]]) -> str:
+    """Return one statement replacing the batch.slos rows of ``days``."""
 
-    except Exception as exc:  # pragma: no cover - defensive logging
-        print(f"calculate_slos.py: error: unexpected failure: {exc}")
+    day_list = ", ".join(f"'{day.isoformat()}'" for day in days)
+    values = ", ".join(
+        f"('{escape_sql_literal(day.isoformat())}', '{escape_sql_literal(slo)}')"
+        for day in days
+        for slo in schedule[day]
+    )
+    statement = f"DELETE FROM batch.slos WHERE process_date IN ({day_list})"
+    if values:
+        # a single statement, so a day is never left half replaced
+        statement = f"WITH replaced AS ({statement}) INSERT INTO batch.slos (process_date, slo) VALUES {values}"
+    return statement
+
+
+def write_schedule(
+    args: argparse.Namespace,
+    environment: str,
+    days: list[datetime.date],
+    schedule: dict[datetime.date, list[str]],
+    job_run: JobRun,
+) -> int:
+    """Replace the SLO rows of ``days`` in the batch database of ``environment``."""
+
+    batch = connect(f"pg{environment}", environment, args)
+    if batch is None:
         return 1
 
+    inserted_rows = 0
+    try:
+        for start in range(0, len(days), SCHEDULE_CHUNK_DAYS):
+            chunk = days[start : start + SCHEDULE_CHUNK_DAYS]
+            statement = schedule_statement(chunk, schedule)
+            result = batch.query({"query": statement, "results": False})
+
+            if result is not True:
+                print(
+                    f"calculate_slos.py: error: {environment}: INSERT query failed with state: "
+                    f"{result}"
+                )
+                return 1
+
+            rows = sum(len(schedule[day]) for day in chunk)
+            inserted_rows += rows
+            job_run.add(rows_written=rows, bytes_written=len(statement))
     finally:
-        try:
-            apollo.close()
-        except Exception:  # pragma: no cover - best effort cleanup
-            pass
+        close(batch)
 
-        try:
-            batch.close()
-        except Exception:  # pragma: no cover - best effort cleanup
-            pass
+    if inserted_rows == 0:
+        print(
+            f"calculate_slos.py: warning: {environment}: no SLO rows were inserted"
+            " (weekends and business holidays only)."
+        )
+    else:
+        print(f"calculate_slos.py: info: {environment}: rewrote {inserted_rows} SLOs for {len(days)} process dates")
+
+    return 0
 
 
 if __name__ == "__main__":  # pragma: no cover - script entry point
@@ -2,129 +2,260 @@ import argparse
 
 import datetime
 
+import sys
+
+from sql_console.fanout import EnvironmentResult, failed, fan_out, parse_environments, report, source_groups
+from sql_console.ledger import JobRun, add_ledger_arguments, run_from_args
+from sql_console.memory import MemoryBudgetExceeded, add_memory_arguments, monitor_from_args
+from sql_console.profiling import add_profile_arguments, profile_from_args
 from sql_console.sql_console import SqlWrapper
+from sql_console.timeouts import add_timeout_arguments, timeout_params
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+
+        description='Gets SOD extract runs from ReportRequest and ships them to Postgres')
+
+    parser.add_argument(
+
+        '--environment',
+
+        dest='environment',
+
+        type=str,
+
+        nargs='+',
+
+        required=True,
+
+        help='Environment(s): [prd][uat]; with several, Apollo is read once per Apollo host and the environments are loaded concurrently')
+
+    parser.add_argument(
+
+        '--process-date',
+
+        dest='process_date',
+
+        type=str,
+
+        default=None,
+
+        help='YYYY-MM-DD')
+
+    parser.add_argument(
+
+        '--postgres-username',
+
+        dest='username',
+
+        type=str,
+
+        default=None,
+
+        help='Username for Postgres')
+
+    parser.add_argument(
+
+        '--postgres-password',
+
+        dest='password',
+
+        type=str,
+
+        default=None,
+
+        help='Password for Postgres')
+
+    parser.add_argument(
+
+        '--notgucci-argument-001',
+
+        dest='flag_001',
+
+        action='store_true',
+
+        help='Stupid workaround for EXT001')
+
+    parser.set_defaults(flag_001=False)
+
+    add_timeout_arguments(parser)
+
+    add_memory_arguments(parser, soft_limit=False)
+
+    add_ledger_arguments(parser)
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def batch_config(args: argparse.Namespace, environment: str) -> dict:
+
+    return {'env': environment, 'method': 'psycopg2', 'server': 'pg' + environment, 'db': 'batch',
+            'credentials': {'user': args.username, 'password': args.password}, 'debug': True, 'format': 'json'}
+
+
+def fetch_extracts(args: argparse.Namespace, apollo: SqlWrapper, nextday: datetime.datetime) -> list:
+
+    # query for all extracts excluding EXT001
+
+    with open('sql/sod_extracts.sql', 'rt') as f:
+        sod_extracts = str(f.read()).replace('\n', ' ')
+
+    sod_extracts = sod_extracts.replace('[[PROCESSDATE]]', '\'' + args.process_date + '\'')
+
+    sod_extracts_results = apollo.query({'query': sod_extracts, 'results': True})
+
+    if sod_extracts_results is False:
+        raise RuntimeError('SOD extract query failed on Apollo')
+
+    if args.flag_001 is True:
+
+        # query for EXT001
+
+        with open('sql/sod_extract_001.sql', 'rt') as f:
+
+            sod_001 = str(f.read()).replace('\n', ' ')
+
+        sod_001 = sod_001.replace('[[PROCESSDATE]]', '\'' + datetime.datetime.strftime(nextday, '%Y-%m-%d') + '\'')
+
+        sod_001_results = apollo.query({'query': sod_001, 'results': True})
+
+        if sod_001_results is False:
+            raise RuntimeError('EXT001 query failed on Apollo')
+
+        if len(sod_001_results) > 0:
+
+            for r in sod_001_results:
+                sod_extracts_results.append(r)
 
-parser = argparse.ArgumentParser(
+    return sod_extracts_results
 
-    description='Gets SOD extract runs from ReportRequest and ships them to Postgres')
 
-parser.add_argument(
+def write_extracts(args: argparse.Namespace, environment: str, nextday: datetime.datetime, sod_extracts_results: list,
+                   job_run: JobRun) -> int:
 
-    '--environment',
+    batch = SqlWrapper({**batch_config(args, environment), **timeout_params(args)})
 
-    dest='environment',
+    try:
 
-    type=str,
+        extracts_already_in_postgres = [i[0] for i in batch.query(
+            {'query': 'SELECT extract FROM batch.sod_extract_runs WHERE process_date=\'' + args.process_date + '\'',
+             'results': True})]
 
-    default=None,
+        failures = 0
 
-    help='Environment: [prod][uat][dev]')
+        for r in sod_extracts_results:
 
-parser.add_argument(
+            if r[1] not in extracts_already_in_postgres:
 
-    '--process-date',
+                if r[1] == '001':
 
-    dest='process_date',
+                    insert_query = 'INSERT INTO batch.sod_extract_runs (process_date,extract,end_time) VALUES(\'' + datetime.datetime.strftime(
+                        nextday, '%Y-%m-%d %H:%M:%S') + '\', \'EXT' + r[1] + '\', \'' + datetime.datetime.strftime(r[0], '%Y-%m-%d %H:%M:%S') + '\')'
 
-    type=str,
+                else:
 
-    default=None,
+                    insert_query = 'INSERT INTO batch.sod_extract_runs (process_date,extract,end_time) VALUES(\'' + args.process_date + '\', \'EXT' + \
+                                   r[1] + '\', \'' + datetime.datetime.strftime(r[0], '%Y-%m-%d %H:%M:%S') + '\')'
 
-    help='YYYY-MM-DD')
+                if batch.query({'query': insert_query, 'results': False}) is True:
+                    job_run.add(rows_written=1, bytes_written=len(insert_query))
+                else:
+                    print('sod_extracts_to_postgres: error: ' + environment + ': insert failed for EXT' + r[1])
+                    failures += 1
 
-parser.add_argument(
+    finally:
 
-    '--postgres-username',
+        batch.close()
 
-    dest='username',
+    return 1 if failures else 0
 
-    type=str,
 
-    default=None,
+def main(argv=None) -> int:
 
-    help='Username for Postgres')
+    args = parse_args(argv)
 
-parser.add_argument(
+    monitor = monitor_from_args('sod_extracts_to_postgres', args)
 
-    '--postgres-password',
+    environments = parse_environments(args.environment)
 
-    dest='password',
+    # calculate next day from given processdate
 
-    type=str,
+    nextday = datetime.datetime.strptime(args.process_date, '%Y-%m-%d') + datetime.timedelta(days=1)
 
-    default=None,
+    job_runs = {environment: run_from_args('sod_extracts_to_postgres', args, batch_config(args, environment), monitor)
+                for environment in environments}
 
-    help='Password for Postgres')
+    for job_run in job_runs.values():
+        job_run.start()
 
-parser.add_argument(
+    results = {}
 
-    '--notgucci-argument-001',
+    try:
 
-    dest='flag_001',
+        with profile_from_args('sod_extracts_to_postgres', args):
 
-    action='store_true',
+            # environments reading the same Apollo host share one read
 
-    help='Stupid workaround for EXT001')
+            for group in source_groups(environments, 'apollo').values():
 
-parser.set_defaults(flag_001=False)
+                try:
 
-args = parser.parse_args()
+                    with monitor.stage('connect'):
 
-# calculate next day from given processdate
+                        apollo = SqlWrapper({'env': group[0], 'method': 'pyodbc', 'server': 'apollo', 'db': 'worldwide', 'debug': True,
+                                             'format': 'json', 'admission': True, **timeout_params(args)})
 
-nextday = datetime.datetime.strptime(args.process_date, '%Y-%m-%d') + datetime.timedelta(days=1)
+                    try:
 
-apollo = SqlWrapper({'env': args.environment, 'method': 'pyodbc', 'server': 'apollo', 'db': 'worldwide', 'debug': True,
-                     'format': 'json'})
+                        with monitor.stage('fetch'):
 
-batch = SqlWrapper({'env': args.environment, 'method': 'psycopg2', 'server': 'pg' + args.environment, 'db': 'batch',
-                    'credentials': {'user': args.username, 'password': args.password}, 'debug': True, 'format': 'json'})
+                            sod_extracts_results = fetch_extracts(args, apollo, nextday)
 
-# query for all extracts excluding EXT001
+                    finally:
 
-with open('sql/sod_extracts.sql', 'rt') as f:
-    sod_extracts = str(f.read()).replace('\n', ' ')
+                        apollo.close()
 
-sod_extracts = sod_extracts.replace('[[PROCESSDATE]]', '\'' + args.process_date + '\'')
+                    for environment in group:
+                        job_runs[environment].add(rows_read=len(sod_extracts_results))
 
-sod_extracts_results = apollo.query({'query': sod_extracts, 'results': True})
+                    with monitor.stage('write'):
 
-if args.flag_001 is True:
+                        results.update(fan_out(group, lambda environment: write_extracts(
+                            args, environment, nextday, sod_extracts_results, job_runs[environment])))
 
-    # query for EXT001
+                except MemoryBudgetExceeded as exc:
 
-    with open('sql/sod_extract_001.sql', 'rt') as f:
+                    print(str(exc))
 
-        sod_001 = str(f.read()).replace('\n', ' ')
+                    break
 
-    sod_001 = sod_001.replace('[[PROCESSDATE]]', '\'' + datetime.datetime.strftime(nextday, '%Y-%m-%d') + '\'')
+                except Exception as exc:
 
-    sod_001_results = apollo.query({'query': sod_001, 'results': True})
+                    print('sod_extracts_to_postgres: error: ' + ', '.join(group) + ': ' + str(exc))
 
-    if len(sod_001_results) > 0:
+                    results.update(failed(group, str(exc)))
 
-        for r in sod_001_results:
-            sod_extracts_results.append(r)
+        for environment in environments:
+            results.setdefault(environment, EnvironmentResult(environment, 1, 0.0, 'not loaded'))
 
-extracts_already_in_postgres = [i[0] for i in batch.query(
-    {'query': 'SELECT extract FROM batch.sod_extract_runs WHERE process_date=\'' + args.process_date + '\'',
-     'results': True})]
+    finally:
 
-for r in sod_extracts_results:
+        for environment, job_run in job_runs.items():
+            result = results.get(environment)
+            job_run.finish(result.exit_code if result else 1, result.error if result else None)
 
-    if r[1] not in extracts_already_in_postgres:
+        if args.memory_report:
+            monitor.report()
 
-        if r[1] == '001':
+    if len(environments) > 1:
+        return report('sod_extracts_to_postgres', results)
 
-            batch.query({
-                            'query': 'INSERT INTO batch.sod_extract_runs (process_date,extract,end_time) VALUES(\'' + datetime.datetime.strftime(
-                                nextday, '%Y-%m-%d %H:%M:%S') + '\', \'EXT' + r[
-                                         1] + '\', \'' + datetime.datetime.strftime(r[0], '%Y-%m-%d %H:%M:%S') + '\')',
-                            'results': False})
+    return results[environments[0]].exit_code
 
-        else:
 
-            batch.query({
-                            'query': 'INSERT INTO batch.sod_extract_runs (process_date,extract,end_time) VALUES(\'' + args.process_date + '\', \'EXT' +
-                                     r[1] + '\', \'' + datetime.datetime.strftime(r[0], '%Y-%m-%d %H:%M:%S') + '\')',
-                            'results': False})
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(main())
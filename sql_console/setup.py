@@ -13,10 +13,14 @@ setup(
     long_description=open('README.md').read(),
     long_description_content_type='text/markdown',  # Ensure rendering of Markdown content
     install_requires=[
-        "pyodbc==4.0.16",
+        "pyodbc>=4.0.32",  # fast_executemany, typed table-valued parameters
         "pymssql",
         "pymysql",
         # "mysql.connector",  # Uncomment if needed
         "psycopg2",
     ],
+    extras_require={
+        "snapshot": ["pyarrow"],
+        "psycopg": ["psycopg"],
+    },
 )
\ No newline at end of file
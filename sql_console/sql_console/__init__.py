@@ -1,5 +1,5 @@
 """Top-level package for sql_console."""
 
-from .sql_console import SqlWrapper, SqlWrapperConnectionError
+from .sql_console import LatencyBudget, SqlWrapper, SqlWrapperConnectionError, SqlWrapperTimeoutError
 
-__all__ = ["SqlWrapper", "SqlWrapperConnectionError"]
+__all__ = ["LatencyBudget", "SqlWrapper", "SqlWrapperConnectionError", "SqlWrapperTimeoutError"]
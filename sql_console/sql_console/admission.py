@@ -0,0 +1,286 @@
+"""Cross-process admission control for source servers.
+
+Every job on a batch host that talks to the same server shares one
+:class:`AdmissionController` state through files in a local lock directory,
+so no external service is involved:
+
+* ``<server>.slot<n>`` files act as a counting semaphore; a query runs while
+  holding an exclusive lock on one slot below the current limit;
+* ``<server>.json`` holds the adaptive limit, per-query latency baselines and
+  queue wait statistics, updated under ``<server>.state.lock``.
+
+A slot is held until the query's results have been fetched.  Latency
+baselines are keyed by :func:`statement_key`, the statement with its
+literals (dates, parameters, partition bounds, watermarks) taken out, so a
+loader's query matches its baseline from one run to the next; callers can
+also pass an explicit key.
+
+The limit adapts AIMD-style: a query that runs much slower than its own
+baseline (or times out) is a congestion signal and multiplies the limit by
+``decrease``; a query within its baseline adds ``1 / limit``, so the limit
+grows by about one per round of queries.  The limit stays between
+``min_limit`` and the ``max_limit`` configured in ``hosts.concurrency``.
+
+Locks are released by the operating system if a process dies, so a crashed
+job never leaks a slot.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from collections.abc import Iterator
+
+from .hosts import db
+from .partition import max_concurrency_for
+from .sql_console import SqlWrapperTimeoutError
+
+try:
+    import fcntl
+except ModuleNotFoundError:  # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_LOCK_DIR = os.environ.get(
+    "SQL_CONSOLE_ADMISSION_DIR", os.path.join(tempfile.gettempdir(), "sql_console_admission")
+)
+MAX_BASELINES = 512
+LITERALS = re.compile(r"N?'(?:[^']|'')*'|\b0x[0-9a-fA-F]+\b|\b\d+(?:\.\d+)?\b")
+
+
+def statement_key(statement: str) -> str:
+    """Return the latency baseline key of ``statement``.
+
+    String, hex and numeric literals are replaced by ``?`` and whitespace is
+    collapsed, so runs of the same query with different values share a key.
+    """
+
+    shape = " ".join(LITERALS.sub("?", statement).split()).lower()
+    return hashlib.sha1(shape.encode("utf-8")).hexdigest()[:16]
+
+
+def _open(path: str):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    return os.fdopen(fd, "r+")
+
+
+def _try_lock(handle) -> bool:
+    try:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _lock(handle) -> None:
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        return
+    while not _try_lock(handle):
+        time.sleep(0.01)
+
+
+def _unlock(handle) -> None:
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+    else:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class AdmissionTicket:
+    """A held slot; ``wait_seconds`` is how long the caller queued for it.
+
+    ``idle`` accumulates time the slot was held while the caller was busy
+    elsewhere (e.g. consuming streamed rows), which is not query latency.
+    """
+
+    def __init__(self, slot: int, handle, wait_seconds: float) -> None:
+        self.slot = slot
+        self.handle = handle
+        self.wait_seconds = wait_seconds
+        self.started = time.monotonic()
+        self.idle = 0.0
+
+
+class AdmissionController:
+    """Limit concurrent queries against ``server`` across processes."""
+
+    def __init__(
+        self,
+        server: str,
+        max_limit: int,
+        min_limit: int = 1,
+        lock_dir: str = DEFAULT_LOCK_DIR,
+        tolerance: float = 2.0,
+        min_slowdown: float = 0.5,
+        decrease: float = 0.7,
+        poll_interval: float = 0.05,
+    ) -> None:
+        self.server = server
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.lock_dir = lock_dir
+        self.tolerance = tolerance
+        self.min_slowdown = min_slowdown
+        self.decrease = decrease
+        self.poll_interval = poll_interval
+
+        os.makedirs(lock_dir, mode=0o777, exist_ok=True)
+        name = re.sub(r"[^\w.-]", "_", server).lower()
+        self._prefix = os.path.join(lock_dir, name)
+
+    @contextlib.contextmanager
+    def _state(self) -> Iterator[dict]:
+        """Yield the shared state under the state lock, writing it back if changed."""
+
+        with _open(self._prefix + ".state.lock") as lock:
+            _lock(lock)
+            try:
+                try:
+                    with open(self._prefix + ".json", encoding="utf-8") as f:
+                        saved = f.read()
+                    state = json.loads(saved)
+                except (OSError, ValueError):
+                    saved, state = None, {}
+                state.setdefault("limit", float(self.max_limit))
+                state["limit"] = min(max(state["limit"], self.min_limit), self.max_limit)
+                yield state
+
+                updated = json.dumps(state)
+                if updated != saved:
+                    tmp = f"{self._prefix}.json.{os.getpid()}"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(updated)
+                    os.replace(tmp, self._prefix + ".json")
+            finally:
+                _unlock(lock)
+
+    def limit(self) -> int:
+        with self._state() as state:
+            return int(state["limit"])
+
+    def stats(self) -> dict:
+        """Return the current limit and queue wait statistics."""
+
+        with self._state() as state:
+            admitted = state.get("admitted", 0)
+            return {
+                "server": self.server,
+                "limit": int(state["limit"]),
+                "admitted": admitted,
+                "queued": state.get("queued", 0),
+                "wait_total": state.get("wait_total", 0.0),
+                "wait_max": state.get("wait_max", 0.0),
+                "wait_mean": state.get("wait_total", 0.0) / admitted if admitted else 0.0,
+            }
+
+    def acquire(self, timeout: float | None = None) -> AdmissionTicket:
+        """Wait for a free slot below the current limit.
+
+        Raises :class:`SqlWrapperTimeoutError` when no slot frees up within
+        ``timeout`` seconds.
+        """
+
+        started = time.monotonic()
+        while True:
+            limit = self.limit()
+            for slot in random.sample(range(limit), limit):
+                handle = _open(f"{self._prefix}.slot{slot}")
+                if _try_lock(handle):
+                    wait = time.monotonic() - started
+                    self._record_wait(wait)
+                    return AdmissionTicket(slot, handle, wait)
+                handle.close()
+
+            if timeout is not None and time.monotonic() - started >= timeout:
+                raise SqlWrapperTimeoutError(
+                    f"AdmissionController: error: no slot free on {self.server} after {timeout:.1f}s"
+                    f" (limit {limit})"
+                )
+            time.sleep(self.poll_interval * (0.5 + random.random()))
+
+    def _record_wait(self, wait: float) -> None:
+        with self._state() as state:
+            state["admitted"] = state.get("admitted", 0) + 1
+            state["wait_total"] = state.get("wait_total", 0.0) + wait
+            state["wait_max"] = max(state.get("wait_max", 0.0), wait)
+            if wait > self.poll_interval:
+                state["queued"] = state.get("queued", 0) + 1
+
+    def release(
+        self,
+        ticket: AdmissionTicket,
+        key: str | None = None,
+        congested: bool | None = None,
+        statement: str | None = None,
+    ) -> None:
+        """Free ``ticket``'s slot and adapt the limit from its latency.
+
+        ``key`` identifies the query so that its latency is compared with its
+        own baseline, and defaults to the :func:`statement_key` of
+        ``statement``; ``congested`` forces the signal (e.g. on timeout).
+        """
+
+        latency = time.monotonic() - ticket.started - ticket.idle
+        if key is None and statement is not None:
+            key = statement_key(statement)
+        try:
+            _unlock(ticket.handle)
+        finally:
+            ticket.handle.close()
+
+        if key is None and congested is None:
+            return
+
+        with self._state() as state:
+            baselines = state.setdefault("baselines", {})
+            if congested is None:
+                baseline = baselines.get(key)
+                congested = (
+                    baseline is not None
+                    and latency > baseline * self.tolerance
+                    and latency - baseline > self.min_slowdown
+                )
+            if key is not None:
+                baseline = baselines.pop(key, latency)
+                # biased towards the fastest observed latency
+                baselines[key] = min(latency, baseline * 0.9 + latency * 0.1)
+                while len(baselines) > MAX_BASELINES:
+                    baselines.pop(next(iter(baselines)))
+
+            now = time.time()
+            if congested:
+                # at most one decrease per latency period, like TCP per-RTT
+                if now - state.get("last_decrease", 0.0) > max(latency, 1.0):
+                    state["limit"] = max(self.min_limit, state["limit"] * self.decrease)
+                    state["last_decrease"] = now
+            else:
+                state["limit"] = min(self.max_limit, state["limit"] + 1.0 / state["limit"])
+
+
+def admission_controller(env: str, server: str, options: object) -> AdmissionController:
+    """Return the controller for ``server`` in ``env``.
+
+    ``options`` is the SqlWrapper 'admission' parameter: ``True`` for the
+    defaults, a dict of :class:`AdmissionController` keyword arguments, or a
+    controller instance to share.
+    """
+
+    if isinstance(options, AdmissionController):
+        return options
+
+    kwargs = dict(options) if isinstance(options, dict) else {}
+    kwargs.setdefault("max_limit", max_concurrency_for(env, server))
+    host = db.get(env, {}).get(server, server)
+    return AdmissionController(host, **kwargs)
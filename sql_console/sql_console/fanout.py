@@ -0,0 +1,95 @@
+"""Load one source read into several environments at once.
+
+Lower environments are kept in sync with production by loading the same
+source rows into each environment's batch database.  Environments whose
+source server resolves to the same host in ``hosts.db`` share a single read
+(:func:`source_groups`), and the writes to each environment's ``pg<env>``
+database run concurrently (:func:`fan_out`), each succeeding or failing on
+its own.
+"""
+
+from __future__ import annotations
+
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from .hosts import db
+
+
+class EnvironmentResult(NamedTuple):
+    environment: str
+    exit_code: int
+    seconds: float = 0.0
+    error: str | None = None
+
+
+def parse_environments(values: Iterable[str]) -> list[str]:
+    """Return the environments named in ``values``, lower-cased and de-duplicated.
+
+    Each value may itself be a comma-separated list.
+    """
+
+    environments: list[str] = []
+    for value in values:
+        for environment in value.split(","):
+            environment = environment.strip().lower()
+            if environment and environment not in environments:
+                environments.append(environment)
+    return environments
+
+
+def source_groups(environments: Iterable[str], server: str) -> dict[str, list[str]]:
+    """Group ``environments`` by the host their ``server`` resolves to.
+
+    Every group needs only one read from the source; the first environment
+    of each group is the one to connect with.
+    """
+
+    groups: dict[str, list[str]] = {}
+    for environment in environments:
+        host = db.get(environment, {}).get(server, server)
+        groups.setdefault(host, []).append(environment)
+    return groups
+
+
+def failed(environments: Iterable[str], error: str) -> dict[str, EnvironmentResult]:
+    """Return a failed result for each of ``environments``."""
+
+    return {environment: EnvironmentResult(environment, 1, 0.0, error) for environment in environments}
+
+
+def fan_out(
+    environments: list[str],
+    write: Callable[[str], int],
+    max_workers: int | None = None,
+) -> dict[str, EnvironmentResult]:
+    """Run ``write(environment)`` for every environment concurrently.
+
+    ``write`` returns the exit status for its environment; an exception
+    fails that environment only.
+    """
+
+    def run(environment: str) -> EnvironmentResult:
+        started = time.monotonic()
+        try:
+            return EnvironmentResult(environment, write(environment), time.monotonic() - started)
+        except Exception as exc:
+            return EnvironmentResult(environment, 1, time.monotonic() - started, f"{type(exc).__name__}: {exc}")
+
+    if len(environments) == 1:
+        return {environments[0]: run(environments[0])}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(environments)) as executor:
+        return dict(zip(environments, executor.map(run, environments)))
+
+
+def report(job: str, results: dict[str, EnvironmentResult]) -> int:
+    """Print one line per environment and return the overall exit status."""
+
+    for result in results.values():
+        status = "ok" if result.exit_code == 0 else "failed"
+        error = f": {result.error}" if result.error else ""
+        print(f"{job}: info: {result.environment}: {status} in {result.seconds:.1f}s{error}")
+    return 0 if all(result.exit_code == 0 for result in results.values()) else 1
@@ -12,3 +12,21 @@ db = {
         'ozark': r'Ozark\\ITTools',
     },
 }
+
+# maximum number of concurrent sessions against a server: the starting limit of
+# admission control, shared by every job on the host, and the pool size of a
+# single partitioned extract
+concurrency = {
+    'prd': {
+        'apollo': 4,
+        'ozark': 6,
+        'eagle': 6,
+        'hood': 4,
+    },
+    'uat': {
+        'apollo': 4,
+        'ozark': 4,
+        'eagle': 4,
+        'hood': 4,
+    },
+}
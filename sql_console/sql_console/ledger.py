@@ -0,0 +1,351 @@
+"""Run ledger for batch jobs.
+
+Every loader records each of its runs as one row of ``batch.job_runs``: start
+and end times, the duration of each stage (taken from the job's
+:class:`~sql_console.memory.MemoryMonitor`), rows read and written, bytes
+written, retries, peak RSS and the exit status, so batch-window trends can be
+charted in Grafana.
+
+A :class:`JobRun` only queues its records.  A :class:`LedgerWriter` thread
+upserts them in batches over its own connection, so tracking never waits on
+the database, and a ledger that cannot be reached costs a warning rather than
+the run.  :func:`shared_writer` keeps one writer per batch database for the
+whole process; the writers are flushed and stopped once, when the interpreter
+exits, rather than at the end of every run.  A ``running`` row is written
+when the run starts and replaced by the final row when it ends, so runs that
+hang or are killed still show up.
+"""
+
+from __future__ import annotations
+
+import argparse
+import atexit
+import datetime
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+from .memory import MemoryMonitor
+from .sql_console import SqlWrapper
+
+LEDGER_TABLE = "batch.job_runs"
+COLUMNS = (
+    "run_id",
+    "job",
+    "environment",
+    "host",
+    "pid",
+    "status",
+    "exit_code",
+    "started_at",
+    "ended_at",
+    "duration_seconds",
+    "stages",
+    "rows_read",
+    "rows_written",
+    "bytes_written",
+    "retries",
+    "peak_rss_mb",
+    "error",
+)
+
+# seconds the shared writers get to flush when the interpreter exits
+EXIT_CLOSE_TIMEOUT = 3.0
+
+_STOP = object()
+_writers: dict[str, LedgerWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def _literal(value: object) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, dict):
+        return "'" + json.dumps(value).replace("'", "''") + "'::jsonb"
+    if isinstance(value, datetime.datetime):
+        return "'" + value.isoformat() + "'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class LedgerWriter:
+    """Background thread that upserts run records into the ledger table.
+
+    ``connection`` holds the :class:`SqlWrapper` parameters of the batch
+    database; the connection is opened by the thread on its first write.
+    Records arriving within ``flush_interval`` seconds of each other are
+    written in one statement.
+    """
+
+    def __init__(
+        self,
+        connection: dict,
+        table: str = LEDGER_TABLE,
+        flush_interval: float = 2.0,
+        max_batch: int = 100,
+        close_timeout: float = 10.0,
+    ) -> None:
+        self.connection = dict(connection)
+        self.connection["debug"] = False
+        # the job's latency budget must not stop its run from being recorded
+        self.connection.pop("budget", None)
+        self.connection.setdefault("connect_timeout", 5)
+        self.connection.setdefault("timeout", 10)
+        self.table = table
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.close_timeout = close_timeout
+        self._queue: queue.Queue = queue.Queue()
+        self._batch: SqlWrapper | None = None
+        self._disabled = False
+        self._thread = threading.Thread(target=self._run, name="sql_console-ledger", daemon=True)
+        self._thread.start()
+
+    def submit(self, record: dict) -> None:
+        self._queue.put(record)
+
+    def close(self, timeout: float | None = None) -> None:
+        """Flush the queued records and stop the thread.
+
+        Waits at most ``timeout`` seconds (``close_timeout`` by default) so a
+        slow ledger cannot hold up the end of the job.
+        """
+
+        self.stop()
+        self.join(self.close_timeout if timeout is None else timeout)
+
+    def stop(self) -> None:
+        """Ask the thread to write what is queued and stop, without waiting."""
+
+        self._queue.put(_STOP)
+
+    def join(self, timeout: float) -> None:
+        self._thread.join(max(timeout, 0))
+        if self._thread.is_alive():
+            print(f"LedgerWriter: warning: gave up writing to {self.table} after {timeout:.0f}s")
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            records = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while records[-1] is not _STOP and len(records) < self.max_batch:
+                try:
+                    records.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            if records[-1] is _STOP:
+                stopping = True
+                records.pop()
+            if records:
+                self._write(records)
+
+        if self._batch is not None:
+            try:
+                self._batch.close()
+            except Exception:
+                pass
+
+    def _connect(self) -> bool:
+        if self._batch is not None:
+            return True
+        if self._disabled:
+            return False
+
+        try:
+            self._batch = SqlWrapper(self.connection)
+        except Exception as exc:
+            print(f"LedgerWriter: warning: could not connect to the ledger, runs will not be recorded: {exc}")
+            self._disabled = True
+            return False
+
+        create = (
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            " run_id uuid PRIMARY KEY, job text NOT NULL, environment text, host text, pid integer,"
+            " status text NOT NULL, exit_code integer, started_at timestamptz NOT NULL, ended_at timestamptz,"
+            " duration_seconds double precision, stages jsonb, rows_read bigint, rows_written bigint,"
+            " bytes_written bigint, retries integer, peak_rss_mb double precision, error text)"
+        )
+        if self._batch.query({"query": create, "results": False}) is False:
+            print(f"LedgerWriter: warning: could not create {self.table}")
+        return True
+
+    def _write(self, records: list[dict]) -> None:
+        if not self._connect():
+            return
+
+        # the start and end record of a short run can arrive in one batch
+        latest = {record["run_id"]: record for record in records}
+        values = ", ".join(
+            "(" + ", ".join(_literal(record[column]) for column in COLUMNS) + ")" for record in latest.values()
+        )
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in COLUMNS if column != "run_id")
+        statement = (
+            f"INSERT INTO {self.table} ({', '.join(COLUMNS)}) VALUES {values}"
+            f" ON CONFLICT (run_id) DO UPDATE SET {updates}"
+        )
+        try:
+            ok = self._batch.query({"query": statement, "results": False}) is not False
+        except Exception:
+            ok = False
+        if not ok:
+            print(f"LedgerWriter: warning: could not record {len(latest)} runs in {self.table}")
+
+
+def shared_writer(connection: dict) -> LedgerWriter:
+    """Return the process-wide :class:`LedgerWriter` for the batch database of ``connection``.
+
+    Jobs that record several runs (one per environment, or one per day)
+    share the writer's thread and connection instead of starting and
+    stopping one for each run.
+    """
+
+    key = json.dumps(
+        {name: value for name, value in connection.items() if name not in ("budget", "debug")},
+        sort_keys=True,
+        default=str,
+    )
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            if not _writers:
+                atexit.register(close_writers)
+            writer = _writers[key] = LedgerWriter(connection)
+        return writer
+
+
+def close_writers(timeout: float = EXIT_CLOSE_TIMEOUT) -> None:
+    """Flush and stop every :func:`shared_writer`, waiting ``timeout`` seconds in all."""
+
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.stop()
+    deadline = time.monotonic() + timeout
+    for writer in writers:
+        writer.join(deadline - time.monotonic())
+
+
+class JobRun:
+    """One run of a job, recorded through ``writer``.
+
+    Use as a context manager around the run.  The exit status is taken from
+    ``exit_code`` (for entry points that return their status), or from the
+    ``SystemExit`` or exception that ended the run.  Finishing only queues
+    the final record; closing ``writer`` is left to its owner.
+    """
+
+    def __init__(
+        self,
+        job: str,
+        environment: str | None = None,
+        writer: LedgerWriter | None = None,
+        monitor: MemoryMonitor | None = None,
+    ) -> None:
+        self.job = job
+        self.environment = environment
+        self.writer = writer
+        self.monitor = monitor
+        self.run_id = str(uuid.uuid4())
+        self.started_at: datetime.datetime | None = None
+        self.exit_code = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.retries = 0
+
+    def add(self, rows_read: int = 0, rows_written: int = 0, bytes_written: int = 0, retries: int = 0) -> None:
+        self.rows_read += rows_read
+        self.rows_written += rows_written
+        self.bytes_written += bytes_written
+        self.retries += retries
+
+    def stages(self) -> dict[str, float]:
+        """Return the seconds spent in each stage recorded by the monitor."""
+
+        stages: dict[str, float] = {}
+        if self.monitor is not None:
+            for sample in self.monitor.samples:
+                stages[sample.stage] = round(stages.get(sample.stage, 0.0) + sample.seconds, 3)
+        return stages
+
+    def record(self, status: str, exit_code: int | None = None, error: str | None = None) -> dict:
+        ended_at = None if status == "running" else datetime.datetime.now(datetime.timezone.utc)
+        return {
+            "run_id": self.run_id,
+            "job": self.job,
+            "environment": self.environment,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "status": status,
+            "exit_code": exit_code,
+            "started_at": self.started_at,
+            "ended_at": ended_at,
+            "duration_seconds": (ended_at - self.started_at).total_seconds() if ended_at else None,
+            "stages": self.stages(),
+            "rows_read": self.rows_read,
+            "rows_written": self.rows_written,
+            "bytes_written": self.bytes_written,
+            "retries": self.retries,
+            "peak_rss_mb": round(self.monitor.peak_rss_mb, 1) if self.monitor is not None else None,
+            "error": error,
+        }
+
+    def start(self) -> None:
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        if self.writer is not None:
+            self.writer.submit(self.record("running"))
+
+    def finish(self, exit_code: int, error: str | None = None, status: str | None = None) -> None:
+        if status is None:
+            status = "succeeded" if exit_code == 0 else "failed"
+        if self.writer is not None:
+            self.writer.submit(self.record(status, exit_code, error))
+
+    def __enter__(self) -> JobRun:
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.finish(self.exit_code)
+        elif issubclass(exc_type, SystemExit):
+            code = exc.code if isinstance(exc.code, int) else (0 if exc.code is None else 1)
+            self.finish(code)
+        elif issubclass(exc_type, KeyboardInterrupt):
+            self.finish(130, status="interrupted")
+        else:
+            self.finish(1, error=f"{exc_type.__name__}: {exc}")
+
+
+def add_ledger_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the shared run ledger options to ``parser``."""
+
+    parser.add_argument(
+        "--no-job-ledger",
+        dest="job_ledger",
+        action="store_false",
+        help=f"Do not record this run in {LEDGER_TABLE}",
+    )
+    parser.set_defaults(job_ledger=True)
+
+
+def run_from_args(
+    job: str,
+    args: argparse.Namespace,
+    connection: dict,
+    monitor: MemoryMonitor | None = None,
+) -> JobRun:
+    """Return the :class:`JobRun` for ``job``, recorded in the batch database of ``connection``."""
+
+    writer = shared_writer(connection) if args.job_ledger else None
+    return JobRun(job, connection.get("env"), writer, monitor)
@@ -0,0 +1,221 @@
+"""Memory accounting and budget enforcement for loader jobs.
+
+:class:`MemoryMonitor` samples the process RSS and, when tracing is enabled,
+the :mod:`tracemalloc` peak around each stage of a job (connect, fetch,
+transform, write) and prints a per-stage report at the end.
+
+Two limits can be configured, in megabytes of RSS:
+
+* over the soft limit, :meth:`MemoryMonitor.batch_size` starts handing out
+  smaller fetch/write batches, and :func:`buffer_rows` stops collecting the
+  result set so the job can process the rest one batch at a time;
+* over the hard limit, :meth:`MemoryMonitor.check` raises
+  :class:`MemoryBudgetExceeded` so the job can abort cleanly before it pushes
+  the host into swap.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+import tracemalloc
+from collections.abc import Iterable, Iterator
+from typing import NamedTuple, TypeVar
+
+MB = 1024 * 1024
+CHECK_EVERY_ROWS = 1000
+
+T = TypeVar("T")
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def current_rss_mb() -> float:
+    """Return the resident set size of this process in megabytes."""
+
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss / MB
+    except ModuleNotFoundError:
+        pass
+
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MB
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    # peak rather than current RSS, but better than nothing
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / MB if sys.platform == "darwin" else peak / 1024
+
+
+class StageSample(NamedTuple):
+    stage: str
+    seconds: float
+    rss_start_mb: float
+    rss_end_mb: float
+    rss_peak_mb: float
+    traced_peak_mb: float | None
+
+
+class MemoryMonitor:
+    """Per-stage memory accounting with soft and hard RSS limits."""
+
+    def __init__(
+        self,
+        job: str,
+        soft_limit_mb: float | None = None,
+        hard_limit_mb: float | None = None,
+        trace: bool = False,
+    ) -> None:
+        self.job = job
+        self.soft_limit_mb = soft_limit_mb
+        self.hard_limit_mb = hard_limit_mb
+        self.trace = trace
+        self.samples: list[StageSample] = []
+        self.peak_rss_mb = current_rss_mb()
+        self.soft_limit_hit = False
+        self._stage_peak = self.peak_rss_mb
+
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def check(self) -> bool:
+        """Sample RSS; return ``True`` when over the soft limit.
+
+        Raises :class:`MemoryBudgetExceeded` when over the hard limit.
+        """
+
+        rss = current_rss_mb()
+        self.peak_rss_mb = max(self.peak_rss_mb, rss)
+        self._stage_peak = max(self._stage_peak, rss)
+
+        if self.hard_limit_mb is not None and rss > self.hard_limit_mb:
+            raise MemoryBudgetExceeded(
+                f"{self.job}: error: RSS {rss:.0f} MB exceeds hard memory limit of {self.hard_limit_mb:.0f} MB"
+            )
+
+        over = self.soft_limit_mb is not None and rss > self.soft_limit_mb
+        if over and not self.soft_limit_hit:
+            print(
+                f"{self.job}: warning: RSS {rss:.0f} MB exceeds soft memory limit of"
+                f" {self.soft_limit_mb:.0f} MB, switching to smaller batches"
+            )
+        self.soft_limit_hit = self.soft_limit_hit or over
+        return over
+
+    def batch_size(self, default: int, minimum: int = 100) -> int:
+        """Return the batch size to use for the next fetch or write.
+
+        ``default`` while under the soft limit; a tenth of it (but at least
+        ``minimum``) once the soft limit has been exceeded.
+        """
+
+        if self.check() or self.soft_limit_hit:
+            return max(min(default, minimum), default // 10)
+        return default
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Account the memory used by the enclosed stage."""
+
+        if self.trace:
+            tracemalloc.reset_peak()
+        start = current_rss_mb()
+        self._stage_peak = start
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            end = current_rss_mb()
+            self._stage_peak = max(self._stage_peak, end)
+            self.peak_rss_mb = max(self.peak_rss_mb, end)
+            traced = tracemalloc.get_traced_memory()[1] / MB if self.trace else None
+            self.samples.append(
+                StageSample(name, time.monotonic() - started, start, end, self._stage_peak, traced)
+            )
+
+        self.check()
+
+    def report(self) -> None:
+        """Print the per-stage memory report."""
+
+        print(f"{self.job}: info: memory report (peak RSS {self.peak_rss_mb:.1f} MB)")
+        for sample in self.samples:
+            traced = f", traced peak {sample.traced_peak_mb:.1f} MB" if sample.traced_peak_mb is not None else ""
+            print(
+                f"{self.job}: info:   {sample.stage}: {sample.seconds:.2f}s,"
+                f" RSS {sample.rss_start_mb:.1f} -> {sample.rss_end_mb:.1f} MB,"
+                f" peak {sample.rss_peak_mb:.1f} MB{traced}"
+            )
+
+
+def buffer_rows(
+    rows: Iterable[T], monitor: MemoryMonitor, check_every: int = CHECK_EVERY_ROWS
+) -> tuple[list[T], Iterator[T] | None]:
+    """Collect ``rows`` into a list while ``monitor`` is under its soft limit.
+
+    Returns ``(rows, None)`` when every row was collected.  Once the soft
+    limit is exceeded, returns the rows collected so far and an iterator over
+    the rest, which the caller should process one batch at a time.
+    """
+
+    iterator = iter(rows)
+    buffered: list[T] = []
+    if monitor.check():
+        return buffered, iterator
+    for row in iterator:
+        buffered.append(row)
+        if len(buffered) % check_every == 0 and monitor.check():
+            return buffered, iterator
+    return buffered, None
+
+
+def add_memory_arguments(parser: argparse.ArgumentParser, soft_limit: bool = True) -> None:
+    """Add the shared memory accounting options to ``parser``.
+
+    Pass ``soft_limit=False`` for jobs that do not fetch or write in batches,
+    where a soft limit would have nothing to shrink.
+    """
+
+    if soft_limit:
+        parser.add_argument(
+            "--memory-soft-limit",
+            dest="memory_soft_limit",
+            type=float,
+            default=None,
+            help="RSS in MB above which the job streams the rest of the load in small batches",
+        )
+    parser.add_argument(
+        "--memory-hard-limit",
+        dest="memory_hard_limit",
+        type=float,
+        default=None,
+        help="RSS in MB above which the job aborts",
+    )
+    parser.add_argument(
+        "--memory-report",
+        dest="memory_report",
+        action="store_true",
+        help="Trace allocations with tracemalloc and print a per-stage memory report",
+    )
+
+
+def monitor_from_args(job: str, args: argparse.Namespace) -> MemoryMonitor:
+    """Return the :class:`MemoryMonitor` configured by :func:`add_memory_arguments`."""
+
+    return MemoryMonitor(
+        job,
+        soft_limit_mb=getattr(args, "memory_soft_limit", None),
+        hard_limit_mb=args.memory_hard_limit,
+        trace=args.memory_report,
+    )
@@ -0,0 +1,316 @@
+"""Key-range partitioned parallel extraction from SQL Server sources.
+
+A single large extract streams through one session.  :class:`PartitionedExtract`
+splits the query over an indexed key or date column into key ranges, runs
+them concurrently on a small pool of :class:`SqlWrapper` connections and
+yields the partitions back in key order.
+
+Range boundaries come from either ``MIN``/``MAX`` of the key in its table
+(or bounds given by the caller), split evenly, or from the SQL Server
+statistics histogram of the key column, split into ranges holding roughly the
+same number of rows.  The bounds are never taken from the query itself, which
+would run the whole extract one extra time.
+
+The query is partitioned in one of two ways:
+
+* if it contains a ``[[PARTITION]]`` placeholder, the placeholder is replaced
+  with the range predicate (useful when the key is not part of the output);
+* otherwise it is wrapped as ``SELECT * FROM (query) AS partitioned_src WHERE
+  <predicate>`` and ``key`` must be a column of the result.
+"""
+
+from __future__ import annotations
+
+import datetime
+import decimal
+import queue
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from .hosts import concurrency
+from .sql_console import SqlWrapper
+
+DEFAULT_MAX_CONCURRENCY = 4
+PARTITION_PLACEHOLDER = "[[PARTITION]]"
+
+
+class PartitionedExtractError(Exception):
+    pass
+
+
+class KeyRange(NamedTuple):
+    """Half-open key range ``[lower, upper)``; ``None`` means unbounded."""
+
+    index: int
+    lower: object
+    upper: object
+
+
+def sql_literal(value: object) -> str:
+    """Return ``value`` as a T-SQL literal."""
+
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return "'" + value.isoformat(timespec="milliseconds") + "'"
+    if isinstance(value, datetime.date):
+        return "'" + value.isoformat() + "'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def split_range(lower: object, upper: object, partitions: int) -> list[object]:
+    """Return the interior boundaries that split ``[lower, upper]`` evenly.
+
+    Only numeric, date and datetime keys can be split arithmetically; other
+    keys (strings, GUIDs) raise :class:`PartitionedExtractError`.
+    """
+
+    if lower is None or upper is None or partitions <= 1:
+        return []
+    for value in (lower, upper):
+        if not isinstance(value, (int, float, decimal.Decimal, datetime.date)):
+            raise PartitionedExtractError(
+                f"PartitionedExtract: error: cannot split {type(value).__name__} keys evenly;"
+                " partition on a numeric or date key, or size the ranges from the statistics histogram"
+            )
+    if not lower < upper:
+        return []
+
+    if isinstance(lower, int):
+        boundaries = [lower + (upper - lower) * i // partitions for i in range(1, partitions)]
+    elif isinstance(lower, datetime.datetime) or not isinstance(lower, datetime.date):
+        boundaries = [lower + (upper - lower) * i / partitions for i in range(1, partitions)]
+    else:
+        days = (upper - lower).days
+        boundaries = [lower + datetime.timedelta(days=days * i // partitions) for i in range(1, partitions)]
+
+    # narrow ranges (e.g. integer keys) can produce duplicate boundaries
+    unique: list[object] = []
+    for boundary in boundaries:
+        if lower < boundary and (not unique or unique[-1] < boundary):
+            unique.append(boundary)
+    return unique
+
+
+def histogram_boundaries(steps: Sequence[tuple[object, float]], partitions: int) -> list[object]:
+    """Return boundaries from histogram ``(range_high_key, rows)`` steps.
+
+    Steps must be in key order.  Boundaries are placed on step keys so that
+    each range holds roughly ``total / partitions`` rows.
+    """
+
+    total = sum(rows for _, rows in steps)
+    if partitions <= 1 or total <= 0:
+        return []
+
+    target = total / partitions
+    boundaries: list[object] = []
+    cumulative = 0.0
+    for key, rows in steps:
+        if cumulative >= target * (len(boundaries) + 1) and len(boundaries) < partitions - 1:
+            boundaries.append(key)
+        cumulative += rows
+    return boundaries
+
+
+def max_concurrency_for(env: str, server: str) -> int:
+    """Return the configured session cap for ``server`` in ``env``."""
+
+    return concurrency.get(env, {}).get(server, DEFAULT_MAX_CONCURRENCY)
+
+
+class PartitionedExtract:
+    """Run ``query`` as ``partitions`` key ranges over a connection pool.
+
+    ``connection`` holds the :class:`SqlWrapper` parameters used to open each
+    pooled connection.  Either ``table``, for histogram sizing and
+    ``MIN``/``MAX`` bounds, or ``bounds`` is required to split the query.
+    """
+
+    def __init__(
+        self,
+        connection: dict,
+        query: str,
+        key: str,
+        partitions: int = 4,
+        table: str | None = None,
+        histogram: bool = False,
+        bounds: tuple[object, object] | None = None,
+        max_concurrency: int | None = None,
+    ) -> None:
+        self.connection = connection
+        self.query = query
+        self.key = key
+        self.partitions = max(partitions, 1)
+        self.table = table
+        self.histogram = histogram
+        self.bounds = bounds
+        self.debug = connection.get("debug", False)
+
+        if max_concurrency is None:
+            max_concurrency = max_concurrency_for(connection["env"], connection["server"])
+        self.workers = max(min(self.partitions, max_concurrency), 1)
+
+        self._pool: queue.Queue[SqlWrapper] = queue.Queue()
+        self._connections: list[SqlWrapper] = []
+        self.description = None
+
+    def _acquire(self) -> SqlWrapper:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            wrapper = SqlWrapper(dict(self.connection))
+            self._connections.append(wrapper)
+            return wrapper
+
+    def _release(self, wrapper: SqlWrapper) -> None:
+        self._pool.put(wrapper)
+
+    def _run(self, sql: str) -> list:
+        wrapper = self._acquire()
+        try:
+            rows = wrapper.query({"query": sql, "results": True})
+            if rows is not False and wrapper.cursor.description:
+                self.description = wrapper.cursor.description
+        finally:
+            self._release(wrapper)
+
+        if rows is False:
+            raise PartitionedExtractError("PartitionedExtract: error: query failed: " + sql)
+        return rows
+
+    def _bounds_query(self) -> str:
+        if self.table is None:
+            # MIN/MAX over the query itself would run the whole extract once more
+            raise PartitionedExtractError("PartitionedExtract: error: 'table' or 'bounds' is required to split the query")
+        return f"SELECT MIN({self.key}), MAX({self.key}) FROM {self.table}"
+
+    def _histogram_query(self) -> str:
+        column = self.key.split(".")[-1].strip("[]").replace("'", "''")
+        table = str(self.table).replace("'", "''")
+        return (
+            "SELECT s.stats_id, CONVERT(nvarchar(64), h.range_high_key, 126), h.range_rows + h.equal_rows "
+            "FROM sys.stats s "
+            "JOIN sys.stats_columns sc ON sc.object_id = s.object_id AND sc.stats_id = s.stats_id AND sc.stats_column_id = 1 "
+            "JOIN sys.columns c ON c.object_id = sc.object_id AND c.column_id = sc.column_id "
+            "CROSS APPLY sys.dm_db_stats_histogram(s.object_id, s.stats_id) h "
+            f"WHERE s.object_id = OBJECT_ID('{table}') AND c.name = '{column}' "
+            "ORDER BY s.stats_id, h.step_number"
+        )
+
+    def boundaries(self) -> list[object]:
+        """Return the interior range boundaries, in key order."""
+
+        if self.partitions <= 1:
+            return []
+
+        if self.histogram and self.table is not None:
+            boundaries = self._histogram_boundaries()
+            if boundaries:
+                return boundaries
+            if self.debug:
+                print("PartitionedExtract: info: no histogram for " + self.key + ", falling back to MIN/MAX")
+
+        if self.bounds is not None:
+            lower, upper = self.bounds
+        else:
+            lower, upper = self._run(self._bounds_query())[0][:2]
+        try:
+            return split_range(lower, upper, self.partitions)
+        except PartitionedExtractError:
+            # keys that cannot be split arithmetically can still use the histogram
+            if self.histogram or self.table is None:
+                raise
+            boundaries = self._histogram_boundaries()
+            if not boundaries:
+                raise
+            if self.debug:
+                print("PartitionedExtract: info: sizing ranges on " + self.key + " from its statistics histogram")
+            return boundaries
+
+    def _histogram_boundaries(self) -> list[object]:
+        steps = self._run(self._histogram_query())
+        if not steps:
+            return []
+        first_stats = steps[0][0]
+        return histogram_boundaries([(row[1], row[2]) for row in steps if row[0] == first_stats], self.partitions)
+
+    def ranges(self) -> list[KeyRange]:
+        boundaries = self.boundaries()
+        edges = [None, *boundaries, None]
+        return [KeyRange(i, edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+    def predicate(self, key_range: KeyRange) -> str:
+        """Return the ``WHERE`` predicate selecting ``key_range``.
+
+        The first range also selects ``NULL`` keys and the outer ranges are
+        unbounded, so rows outside stale statistics are never lost.
+        """
+
+        clauses = []
+        if key_range.lower is not None:
+            clauses.append(f"{self.key} >= {sql_literal(key_range.lower)}")
+        if key_range.upper is not None:
+            clauses.append(f"{self.key} < {sql_literal(key_range.upper)}")
+        if not clauses:
+            return "1=1"
+        if key_range.lower is None:
+            return f"({clauses[0]} OR {self.key} IS NULL)"
+        return "(" + " AND ".join(clauses) + ")"
+
+    def partition_query(self, key_range: KeyRange) -> str:
+        predicate = self.predicate(key_range)
+        if PARTITION_PLACEHOLDER in self.query:
+            return self.query.replace(PARTITION_PLACEHOLDER, predicate)
+        return f"SELECT * FROM ({self.query}) AS partitioned_src WHERE {predicate}"
+
+    def iter_partitions(self) -> Iterator[tuple[KeyRange, list]]:
+        """Yield ``(range, rows)`` for each partition in key order.
+
+        At most ``workers`` partitions run at once and only a bounded number of
+        finished partitions are held ahead of the consumer.
+        """
+
+        ranges = self.ranges()
+        if self.debug:
+            print(
+                f"PartitionedExtract: info: extracting {len(ranges)} partitions on {self.key}"
+                f" with {self.workers} connections to {self.connection['server']}"
+            )
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            upcoming = iter(ranges)
+            try:
+                for key_range in upcoming:
+                    pending.append((key_range, executor.submit(self._run, self.partition_query(key_range))))
+                    if len(pending) >= self.workers * 2:
+                        break
+
+                while pending:
+                    key_range, future = pending.pop(0)
+                    rows = future.result()
+                    next_range = next(upcoming, None)
+                    if next_range is not None:
+                        pending.append((next_range, executor.submit(self._run, self.partition_query(next_range))))
+                    yield key_range, rows
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def rows(self) -> Iterator[object]:
+        """Yield every row of every partition, in key order."""
+
+        for _, rows in self.iter_partitions():
+            yield from rows
+
+    def close(self) -> None:
+        for wrapper in self._connections:
+            try:
+                wrapper.close()
+            except Exception:
+                pass
+        self._connections = []
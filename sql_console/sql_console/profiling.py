@@ -0,0 +1,358 @@
+"""Built-in profiling for loader jobs.
+
+:class:`Profiler` records where a run spends its time as call stacks, in one
+of two modes:
+
+* ``sample`` (the default) -- a background thread snapshots the stack of
+  every thread each ``interval`` seconds.  The overhead is bounded by the
+  interval, so it is safe to leave on in production;
+* ``deterministic`` -- a :func:`sys.setprofile` hook times every Python and
+  C call exactly, at the cost of slowing the job down considerably.
+
+On stop the stacks are written as collapsed stacks (``a;b;c <microseconds>``,
+the input format of ``flamegraph.pl`` and speedscope) or, when the output
+path ends in ``.json``, as a speedscope profile, and a summary of the hottest
+functions is printed with the time split between the database drivers and
+Python.  The profiler's own thread and the ledger writer are not profiled,
+and time that threads spend waiting is kept in the stacks but left out of the
+hot functions and reported per thread.  Sampled stacks hold Python frames
+only, so in ``sample`` mode a wait is recognised by its Python caller: the
+``threading`` and ``queue`` waits and the known wait loops of sql_console; a
+``time.sleep`` or blocking C call anywhere else counts as busy time of the
+function that made it.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from types import CodeType, FrameType
+
+DRIVER_MODULES = frozenset({"pyodbc", "pymssql", "_mssql", "pymysql", "psycopg2", "psycopg", "psycopg_c", "psycopg_binary"})
+# SqlWrapper methods that call into the driver; C drivers do not show up in
+# sampled stacks, so time at these frames is spent in the driver
+DRIVER_CALLS = frozenset(
+    f"sql_console.sql_console:SqlWrapper.{name}"
+    for name in (
+        "__init__", "query", "iter_query", "_iter_rows", "_pipeline", "copy", "_execute_bulk", "bulk_load",
+        "proc", "_set_timeout", "cancel", "close",
+    )
+)
+# leaf frames of a thread that is blocked rather than working
+IDLE_CALLS = frozenset(
+    {
+        "threading:Condition.wait",
+        "threading:Event.wait",
+        "threading:Thread.join",
+        "threading:Thread._wait_for_tstate_lock",
+        "queue:Queue.get",
+        "concurrent.futures.thread:_worker",
+        "selectors:EpollSelector.select",
+        "selectors:PollSelector.select",
+        "selectors:SelectSelector.select",
+        "_thread:lock.acquire",
+        "_thread:RLock.acquire",
+        "_queue:SimpleQueue.get",
+        "time:sleep",
+    }
+)
+# Python functions that spend their own time in a blocking C call (sleep,
+# flock); sampled stacks end at them rather than at the call
+IDLE_CALLERS = frozenset(
+    {
+        "sql_console.admission:AdmissionController.acquire",
+        "sql_console.admission:_lock",
+    }
+)
+# background threads of sql_console itself, never profiled
+SKIP_THREADS = frozenset({"sql_console-profiler", "sql_console-ledger"})
+MAX_DEPTH = 256
+MODES = ("sample", "deterministic")
+
+_labels: dict[CodeType, str] = {}
+
+
+def frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    label = _labels.get(code)
+    if label is None:
+        module = frame.f_globals.get("__name__", "?")
+        label = _labels[code] = f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+    return label
+
+
+def c_label(function: object) -> str:
+    owner = getattr(function, "__self__", None)
+    module = getattr(function, "__module__", None)
+    if module is None and owner is not None:
+        module = type(owner).__module__ if not isinstance(owner, type(sys)) else owner.__name__
+    return f"{module or 'builtins'}:{getattr(function, '__qualname__', repr(function))}"
+
+
+def frame_stack(frame: FrameType | None) -> list[str]:
+    """Return the labels of ``frame`` and its callers, outermost first."""
+
+    labels = []
+    while frame is not None and len(labels) < MAX_DEPTH:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def is_driver_stack(stack: tuple[str, ...], sampled: bool) -> bool:
+    """Whether time at the leaf of ``stack`` is spent in a database driver."""
+
+    if any(label.partition(":")[0].split(".")[0] in DRIVER_MODULES for label in stack[1:]):
+        return True
+    return sampled and stack[-1] in DRIVER_CALLS
+
+
+def is_idle_stack(stack: tuple[str, ...], sampled: bool) -> bool:
+    """Whether the thread of ``stack`` is waiting rather than running."""
+
+    return stack[-1] in IDLE_CALLS or (sampled and stack[-1] in IDLE_CALLERS)
+
+
+class _Tracer:
+    """:func:`sys.setprofile` hook attributing elapsed time to the current stack."""
+
+    def __init__(self, stacks: defaultdict[tuple[str, ...], float]) -> None:
+        self.stacks = stacks
+        self._threads: dict[int, list] = {}
+        self._skipped: set[int] = set()
+
+    def __call__(self, frame: FrameType, event: str, arg: object) -> None:
+        now = time.perf_counter()
+        ident = threading.get_ident()
+        state = self._threads.get(ident)
+        if state is None:
+            if ident in self._skipped:
+                return
+            name = threading.current_thread().name
+            if name in SKIP_THREADS:
+                self._skipped.add(ident)
+                return
+            root = "thread:" + name
+            stack = [root, *frame_stack(frame.f_back if event == "call" else frame)]
+            state = self._threads[ident] = [stack, now]
+
+        stack = state[0]
+        self.stacks[tuple(stack)] += now - state[1]
+        if event == "call":
+            stack.append(frame_label(frame))
+        elif event == "c_call":
+            stack.append(c_label(arg))
+        elif len(stack) > 1:
+            stack.pop()
+        # leave the hook's own cost out of the caller's time
+        state[1] = time.perf_counter()
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, stacks: defaultdict[tuple[str, ...], float], interval: float) -> None:
+        super().__init__(name="sql_console-profiler", daemon=True)
+        self.stacks = stacks
+        self.interval = interval
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        last = time.perf_counter()
+        while not self._stop_event.wait(self.interval):
+            now = time.perf_counter()
+            weight, last = now - last, now
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if ident == self.ident or name in SKIP_THREADS:
+                    continue
+                stack = ("thread:" + name, *frame_stack(frame))
+                self.stacks[stack] += weight
+            self.samples += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+class Profiler:
+    """Profile the enclosed code and write the stacks to ``output``."""
+
+    def __init__(
+        self,
+        job: str,
+        output: str,
+        mode: str = "sample",
+        interval: float = 0.01,
+        top: int = 15,
+    ) -> None:
+        if mode not in MODES:
+            raise ValueError(f"profile mode must be one of {MODES}")
+        self.job = job
+        self.output = output
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+        self.stacks: defaultdict[tuple[str, ...], float] = defaultdict(float)
+        self._sampler: _Sampler | None = None
+        self._started = 0.0
+        self.elapsed = 0.0
+
+    def start(self) -> None:
+        self._started = time.perf_counter()
+        if self.mode == "sample":
+            self._sampler = _Sampler(self.stacks, self.interval)
+            self._sampler.start()
+            return
+
+        tracer = _Tracer(self.stacks)
+        if hasattr(threading, "setprofile_all_threads"):
+            threading.setprofile_all_threads(tracer)
+        else:
+            threading.setprofile(tracer)
+        sys.setprofile(tracer)
+
+    def stop(self) -> None:
+        if self.mode == "sample":
+            self._sampler.stop()
+        else:
+            sys.setprofile(None)
+            if hasattr(threading, "setprofile_all_threads"):
+                threading.setprofile_all_threads(None)
+            else:
+                threading.setprofile(None)
+        self.elapsed = time.perf_counter() - self._started
+
+    def __enter__(self) -> Profiler:
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+        try:
+            self.write()
+            self.summary()
+        except OSError as err:
+            print(f"{self.job}: warning: could not write profile to {self.output}: {err}")
+
+    def write(self) -> None:
+        if self.output.endswith(".json"):
+            self._write_speedscope()
+        else:
+            self._write_collapsed()
+
+    def _write_collapsed(self) -> None:
+        with open(self.output, "w", encoding="utf-8") as f:
+            for stack, seconds in self.stacks.items():
+                micros = int(round(seconds * 1_000_000))
+                if micros > 0:
+                    f.write(";".join(label.replace(";", ":") for label in stack) + f" {micros}\n")
+
+    def _write_speedscope(self) -> None:
+        frames: dict[str, int] = {}
+        samples = []
+        weights = []
+        for stack, seconds in self.stacks.items():
+            samples.append([frames.setdefault(label, len(frames)) for label in stack])
+            weights.append(seconds)
+
+        document = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "sql_console.profiling",
+            "name": self.job,
+            "shared": {"frames": [{"name": label} for label in frames]},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": f"{self.job} ({self.mode})",
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+        }
+        with open(self.output, "w", encoding="utf-8") as f:
+            json.dump(document, f)
+
+    def hot_functions(self) -> list[tuple[str, float, bool]]:
+        """Return ``(function, self seconds, in driver)``, hottest first.
+
+        Stacks of waiting threads are left out; see :meth:`threads`.
+        """
+
+        totals: dict[tuple[str, bool], float] = defaultdict(float)
+        for stack, seconds in self.stacks.items():
+            if len(stack) > 1 and not is_idle_stack(stack, self.mode == "sample"):
+                totals[(stack[-1], is_driver_stack(stack, self.mode == "sample"))] += seconds
+        return sorted(((label, seconds, driver) for (label, driver), seconds in totals.items()), key=lambda item: -item[1])
+
+    def threads(self) -> dict[str, tuple[float, float]]:
+        """Return ``{thread: (busy seconds, idle seconds)}``."""
+
+        totals: dict[str, list[float]] = defaultdict(lambda: [0.0, 0.0])
+        for stack, seconds in self.stacks.items():
+            totals[stack[0].partition(":")[2]][is_idle_stack(stack, self.mode == "sample")] += seconds
+        return {thread: (busy, idle) for thread, (busy, idle) in totals.items()}
+
+    def summary(self) -> None:
+        """Print the hottest functions, the driver/Python split and the time per thread."""
+
+        functions = self.hot_functions()
+        driver = sum(seconds for _, seconds, in_driver in functions if in_driver)
+        python = sum(seconds for _, seconds, in_driver in functions if not in_driver)
+        total = driver + python or 1.0
+        threads = self.threads()
+        detail = f", {self._sampler.samples} samples" if self._sampler is not None else ""
+        print(
+            f"{self.job}: info: profile ({self.mode}{detail}) written to {self.output}:"
+            f" {self.elapsed:.2f}s wall, driver {driver:.2f}s ({driver / total:.0%}),"
+            f" python {python:.2f}s ({python / total:.0%}) busy across {len(threads)} threads"
+        )
+        if len(threads) > 1:
+            for thread, (busy, idle) in sorted(threads.items(), key=lambda item: -item[1][0]):
+                print(f"{self.job}: info:   thread {thread}: busy {busy:.2f}s, waiting {idle:.2f}s")
+        for label, seconds, in_driver in functions[: self.top]:
+            kind = "driver" if in_driver else "python"
+            print(f"{self.job}: info:   {seconds:8.3f}s {seconds / total:4.0%} {kind:6} {label}")
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the shared profiling options to ``parser``."""
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        type=str,
+        default=None,
+        help="Profile the run and write collapsed stacks to this file (speedscope JSON if it ends in .json)",
+    )
+    parser.add_argument(
+        "--profile-mode",
+        dest="profile_mode",
+        choices=MODES,
+        default="sample",
+        help="'sample' (low overhead, safe in production) or 'deterministic' (exact, slow)",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        dest="profile_interval",
+        type=float,
+        default=10.0,
+        help="Sampling interval in milliseconds",
+    )
+
+
+def profile_from_args(job: str, args: argparse.Namespace) -> contextlib.AbstractContextManager:
+    """Return the :class:`Profiler` configured by :func:`add_profile_arguments`, or a no-op."""
+
+    if not args.profile:
+        return contextlib.nullcontext()
+    return Profiler(job, args.profile, args.profile_mode, args.profile_interval / 1000)
@@ -0,0 +1,171 @@
+"""Incrementally maintained rollup tables for Grafana dashboards.
+
+Loaders like ``tidal_to_grafana_v2.py`` append raw job rows to the ``batch``
+database.  :class:`RollupStage` keeps a per-interval summary of each target
+table next to it so dashboards can read small pre-aggregated tables instead
+of scanning the raw history:
+
+* ``<table>_rollup_<interval>`` holds run counts and total/min/max durations
+  per job per interval;
+* ``<table>_rollup_<interval>_hist`` holds a log2 histogram of durations,
+  which can be merged incrementally;
+* the ``<table>_rollup_<interval>_pct`` view adds approximate p50/p90/p99
+  durations computed from the histogram.
+
+Each INSERT sent to a rolled-up table is rewritten by
+:meth:`RollupStage.rewrite` into a single statement that also upserts the
+rows it inserted into the rollups, so the raw rows and their rollups commit
+together; a failed or killed load cannot leave them disagreeing, and nothing
+is ever recomputed from the raw table.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import NamedTuple
+
+from .sql_console import SqlWrapper
+
+INSERT_TARGET = re.compile(r'^\s*INSERT\s+INTO\s+([\w."]+)', re.IGNORECASE)
+RETURNING_CLAUSE = re.compile(r'\bRETURNING\b', re.IGNORECASE)
+CONFLICT_UPDATE = re.compile(r'\bON\s+CONFLICT\b.*?\bDO\s+UPDATE\b', re.IGNORECASE | re.DOTALL)
+MAX_BUCKET = 24
+INTERVALS = ("hour", "day")
+
+
+class RollupSpec(NamedTuple):
+    """Which columns of the target table describe a job run."""
+
+    tables: frozenset[str]
+    job_column: str
+    time_column: str
+    duration_expression: str
+    interval: str = "day"
+
+
+def duration_bucket(seconds: str) -> str:
+    """Return the SQL expression for the histogram bucket of ``seconds``.
+
+    Bucket 0 holds durations under one second; bucket ``b`` holds
+    ``[2 ** (b - 1), 2 ** b)`` seconds.
+    """
+
+    return (
+        f"CASE WHEN {seconds} < 1 THEN 0"
+        f" ELSE LEAST(floor(log(2, {seconds}::numeric))::integer + 1, {MAX_BUCKET}) END"
+    )
+
+
+def _table_name(target: str) -> str:
+    return target.replace('"', "").lower()
+
+
+class RollupStage:
+    """Roll the rows inserted into the target tables up as part of each INSERT."""
+
+    def __init__(self, spec: RollupSpec, batch: SqlWrapper, debug: bool = True) -> None:
+        if spec.interval not in INTERVALS:
+            raise ValueError(f"rollup interval must be one of {INTERVALS}")
+        self.spec = spec
+        self.batch = batch
+        self.debug = debug
+        self.tables = frozenset(_table_name(table) for table in spec.tables)
+        self._skipped: set[str] = set()
+
+    def target(self, statement: str) -> str | None:
+        """Return the rolled-up table ``statement`` inserts into, if any."""
+
+        match = INSERT_TARGET.match(statement)
+        if match is None:
+            return None
+        table = _table_name(match.group(1))
+        return table if table in self.tables else None
+
+    def _skip(self, table: str, reason: str) -> None:
+        if table not in self._skipped:
+            self._skipped.add(table)
+            print(f"RollupStage: warning: INSERT into {table} {reason}, not rolling it up")
+
+    def rewrite(self, statement: str) -> str:
+        """Return ``statement`` extended to upsert the rows it inserts into the rollups.
+
+        Statements that already return something are left alone, and so are
+        upserts (``ON CONFLICT ... DO UPDATE``), whose RETURNING rows include
+        the updated ones that were rolled up when first inserted.
+        """
+
+        table = self.target(statement)
+        if table is None:
+            return statement
+        if RETURNING_CLAUSE.search(statement):
+            self._skip(table, "already has a RETURNING clause")
+            return statement
+        if CONFLICT_UPDATE.search(statement):
+            self._skip(table, "updates existing rows on conflict")
+            return statement
+
+        rollup, hist, _ = self._names(table)
+        spec = self.spec
+        return (
+            f"WITH inserted AS ({statement.rstrip().rstrip(';')}"
+            f" RETURNING {spec.job_column} AS rollup_job, {spec.time_column} AS rollup_time,"
+            f" ({spec.duration_expression}) AS rollup_duration),"
+            " new_runs AS (SELECT rollup_job::text AS job,"
+            f" date_trunc('{spec.interval}', rollup_time)::timestamp AS period,"
+            " rollup_duration::double precision AS duration"
+            " FROM inserted WHERE rollup_job IS NOT NULL AND rollup_time IS NOT NULL),"
+            f" rolled AS (INSERT INTO {rollup} AS t"
+            " (job, period, runs, timed_runs, total_duration, min_duration, max_duration)"
+            " SELECT job, period, count(*), count(duration), COALESCE(sum(duration), 0), min(duration), max(duration)"
+            " FROM new_runs GROUP BY job, period"
+            " ON CONFLICT (job, period) DO UPDATE SET"
+            " runs = t.runs + EXCLUDED.runs,"
+            " timed_runs = t.timed_runs + EXCLUDED.timed_runs,"
+            " total_duration = t.total_duration + EXCLUDED.total_duration,"
+            " min_duration = LEAST(t.min_duration, EXCLUDED.min_duration),"
+            " max_duration = GREATEST(t.max_duration, EXCLUDED.max_duration))"
+            f" INSERT INTO {hist} AS t (job, period, bucket, runs)"
+            f" SELECT job, period, {duration_bucket('duration')}, count(*)"
+            " FROM new_runs WHERE duration IS NOT NULL GROUP BY 1, 2, 3"
+            " ON CONFLICT (job, period, bucket) DO UPDATE SET runs = t.runs + EXCLUDED.runs"
+        )
+
+    def _names(self, table: str) -> tuple[str, str, str]:
+        rollup = f"{table}_rollup_{self.spec.interval}"
+        return rollup, rollup + "_hist", rollup + "_pct"
+
+    def create(self) -> bool:
+        """Create the rollup tables and views of every target table, if missing."""
+
+        for table in sorted(self.tables):
+            rollup, hist, pct = self._names(table)
+            statements = [
+                f"CREATE TABLE IF NOT EXISTS {rollup} ("
+                " job text NOT NULL, period timestamp NOT NULL, runs bigint NOT NULL, timed_runs bigint NOT NULL,"
+                " total_duration double precision NOT NULL, min_duration double precision, max_duration double precision,"
+                " PRIMARY KEY (job, period))",
+                f"CREATE TABLE IF NOT EXISTS {hist} ("
+                " job text NOT NULL, period timestamp NOT NULL, bucket integer NOT NULL, runs bigint NOT NULL,"
+                " PRIMARY KEY (job, period, bucket))",
+                f"CREATE OR REPLACE VIEW {pct} AS"
+                " SELECT r.job, r.period, r.runs, r.timed_runs, r.total_duration / NULLIF(r.timed_runs, 0) AS avg_duration,"
+                " r.min_duration, r.max_duration,"
+                " LEAST(p.p50, r.max_duration) AS p50_duration, LEAST(p.p90, r.max_duration) AS p90_duration,"
+                " LEAST(p.p99, r.max_duration) AS p99_duration"
+                f" FROM {rollup} r LEFT JOIN ("
+                " SELECT job, period,"
+                " MIN(upper_bound) FILTER (WHERE cumulative >= 0.50 * total) AS p50,"
+                " MIN(upper_bound) FILTER (WHERE cumulative >= 0.90 * total) AS p90,"
+                " MIN(upper_bound) FILTER (WHERE cumulative >= 0.99 * total) AS p99"
+                " FROM (SELECT job, period, power(2, bucket)::double precision AS upper_bound,"
+                " SUM(runs) OVER (PARTITION BY job, period ORDER BY bucket) AS cumulative,"
+                " SUM(runs) OVER (PARTITION BY job, period) AS total"
+                f" FROM {hist}) h GROUP BY job, period) p USING (job, period)",
+            ]
+            for statement in statements:
+                if self.batch.query({"query": statement, "results": False}) is False:
+                    print(f"RollupStage: error: could not create rollup tables for {table}")
+                    return False
+            if self.debug:
+                print(f"RollupStage: info: rolling {table} up into {rollup}")
+        return True
@@ -0,0 +1,287 @@
+"""Columnar snapshots of source query results.
+
+A snapshot is an Arrow IPC file holding one job's source result set together
+with the query, parameters and column names that produced it.  Loaders write a
+snapshot while they extract (``--snapshot-out``) and can later replay it into
+the destination (``--replay``) without touching the source server again.
+
+Snapshots are written in record batches as rows arrive, compressed with zstd,
+and read back through a memory map so replaying a large snapshot does not
+need to read the whole file up front.
+
+``pyarrow`` is an optional dependency: ``pip install sql_console[snapshot]``.
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import os
+from collections.abc import Iterable, Iterator, Sequence
+
+METADATA_KEY = b"sql_console.snapshot"
+SNAPSHOT_BATCH_ROWS = 10000
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+    except ModuleNotFoundError as exc:
+        raise ModuleNotFoundError(
+            "sql_console.snapshot requires pyarrow; install sql_console[snapshot]", name=exc.name
+        ) from exc
+    return pyarrow
+
+
+def cursor_columns(description: Sequence[Sequence[object]] | None, width: int) -> list[str]:
+    """Return column names from a DB-API ``cursor.description``.
+
+    Falls back to ``column_<n>`` when the description is unavailable, and
+    de-duplicates repeated or empty names so they are valid Arrow fields.
+    """
+
+    names = [str(column[0]) for column in description] if description else []
+    if len(names) != width:
+        names = [f"column_{index}" for index in range(width)]
+
+    seen: dict[str, int] = {}
+    unique = []
+    for index, name in enumerate(names):
+        name = name or f"column_{index}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}_{seen[name]}"
+        else:
+            seen[name] = 0
+        unique.append(name)
+    return unique
+
+
+class SnapshotWriter:
+    """Stream rows into a compressed Arrow IPC snapshot file.
+
+    The schema is inferred from the first batch of rows.  When a later batch
+    does not fit it (an integer column receiving floats, a wider decimal, the
+    first values of a column that was all ``NULL``) the column is promoted to
+    a type holding both, and the batches already written are rewritten with
+    the new schema; values that fit no common type are stored as strings.
+
+    Rows are written to ``<path>.tmp``, which replaces ``path`` only when the
+    writer is closed without error, so a failed extract never leaves a
+    truncated snapshot behind.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        columns: Sequence[str],
+        metadata: dict,
+        compression: str | None = "zstd",
+        batch_rows: int = SNAPSHOT_BATCH_ROWS,
+    ) -> None:
+        self.path = path
+        self.columns = list(columns)
+        self.metadata = dict(metadata)
+        self.metadata.setdefault("created_at", datetime.datetime.now(datetime.timezone.utc).isoformat())
+        self.metadata["columns"] = self.columns
+        self.compression = compression
+        self.batch_rows = batch_rows
+        self.row_count = 0
+        self._pa = _pyarrow()
+        self._tmp = path + ".tmp"
+        self._buffer: list[Sequence[object]] = []
+        self._schema = None
+        self._writer = None
+        self._sink = None
+
+    def __enter__(self) -> SnapshotWriter:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _make_schema(self, types: Sequence[object]):
+        pa = self._pa
+        return pa.schema(
+            [pa.field(name, type_) for name, type_ in zip(self.columns, types)],
+            metadata={METADATA_KEY: json.dumps(self.metadata, default=str).encode("utf-8")},
+        )
+
+    def _promote(self, current, inferred):
+        """Return a type that holds values of both ``current`` and ``inferred``."""
+
+        pa = self._pa
+        types = pa.types
+        if types.is_null(current) or current == inferred:
+            return inferred
+        if types.is_null(inferred):
+            return current
+        if types.is_integer(current) and types.is_integer(inferred):
+            return pa.int64()
+        if types.is_decimal(current) or types.is_decimal(inferred):
+            if types.is_floating(current) or types.is_floating(inferred):
+                return pa.float64()
+            if not all(types.is_decimal(t) or types.is_integer(t) for t in (current, inferred)):
+                return pa.string()
+            # integers need up to 19 digits before the point
+            scale = max(getattr(t, "scale", 0) for t in (current, inferred))
+            digits = max(t.precision - t.scale if types.is_decimal(t) else 19 for t in (current, inferred))
+            return pa.decimal128(digits + scale, scale) if digits + scale <= 38 else pa.string()
+        if (types.is_integer(current) or types.is_floating(current)) and (
+            types.is_integer(inferred) or types.is_floating(inferred)
+        ):
+            return pa.float64()
+        if types.is_timestamp(current) and types.is_date(inferred):
+            return current
+        if types.is_date(current) and types.is_timestamp(inferred):
+            return inferred
+        return pa.string()
+
+    def _column(self, type_, values: list[object]):
+        """Return the type to store ``values`` as, promoted from ``type_``, and their array."""
+
+        pa = self._pa
+        errors = (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError)
+        if not pa.types.is_string(type_):
+            try:
+                array = pa.array(values)
+            except errors:
+                array = None
+            if array is not None:
+                if array.type == type_:
+                    return type_, array
+                promoted = self._promote(type_, array.type)
+                try:
+                    return promoted, self._array(promoted, values)
+                except errors:
+                    pass
+        return pa.string(), self._array(pa.string(), values)
+
+    def _array(self, type_, values: list[object]):
+        pa = self._pa
+        if pa.types.is_string(type_):
+            values = [None if value is None else str(value) for value in values]
+        return pa.array(values, type=type_)
+
+    def _open(self, schema) -> None:
+        pa = self._pa
+        self._schema = schema
+        self._sink = pa.OSFile(self._tmp, "wb")
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+        self._writer = pa.ipc.new_file(self._sink, schema, options=options)
+
+    def _rewrite(self, schema) -> None:
+        """Rewrite the batches written so far with ``schema``."""
+
+        pa = self._pa
+        self._writer.close()
+        self._sink.close()
+        previous = self._tmp + ".old"
+        os.replace(self._tmp, previous)
+        try:
+            self._open(schema)
+            with pa.memory_map(previous, "r") as source:
+                reader = pa.ipc.open_file(source)
+                for index in range(reader.num_record_batches):
+                    table = pa.Table.from_batches([reader.get_batch(index)]).cast(schema)
+                    self._writer.write_table(table)
+        finally:
+            os.remove(previous)
+
+    def _flush(self) -> None:
+        pa = self._pa
+        rows, self._buffer = self._buffer, []
+
+        # columns with no values yet stay null-typed until they get some
+        types = list(self._schema.types) if self._schema is not None else [pa.null()] * len(self.columns)
+        arrays = []
+        for index in range(len(self.columns)):
+            types[index], array = self._column(types[index], [row[index] for row in rows])
+            arrays.append(array)
+
+        if self._writer is None:
+            self._open(self._make_schema(types))
+        elif types != list(self._schema.types):
+            self._rewrite(self._make_schema(types))
+
+        if rows:
+            self._writer.write_batch(pa.record_batch(arrays, schema=self._schema))
+
+    def write(self, rows: Iterable[Sequence[object]]) -> None:
+        for row in rows:
+            self._buffer.append(tuple(row))
+            self.row_count += 1
+            if len(self._buffer) >= self.batch_rows:
+                self._flush()
+
+    def close(self) -> None:
+        """Finish the snapshot and move it into place."""
+
+        if self._writer is None or self._buffer:
+            self._flush()
+        self._writer.close()
+        self._sink.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        """Discard the partly written snapshot."""
+
+        try:
+            if self._writer is not None:
+                self._writer.close()
+                self._sink.close()
+        finally:
+            if os.path.exists(self._tmp):
+                os.remove(self._tmp)
+
+
+class SnapshotReader:
+    """Memory-mapped reader over a snapshot written by :class:`SnapshotWriter`."""
+
+    def __init__(self, path: str) -> None:
+        pa = _pyarrow()
+        self.path = path
+        self._source = pa.memory_map(path, "r")
+        self._reader = pa.ipc.open_file(self._source)
+        raw = (self._reader.schema.metadata or {}).get(METADATA_KEY, b"{}")
+        self.metadata: dict = json.loads(raw.decode("utf-8"))
+        self.columns: list[str] = self._reader.schema.names
+
+    def __enter__(self) -> SnapshotReader:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    @property
+    def row_count(self) -> int:
+        return sum(self._reader.get_batch(i).num_rows for i in range(self._reader.num_record_batches))
+
+    def __iter__(self) -> Iterator[tuple]:
+        """Yield rows as tuples, one record batch at a time."""
+
+        for index in range(self._reader.num_record_batches):
+            batch = self._reader.get_batch(index)
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+
+    def close(self) -> None:
+        self._source.close()
+
+
+def write_snapshot(path: str, rows: Iterable[Sequence[object]], columns: Sequence[str], metadata: dict) -> int:
+    """Write ``rows`` to a snapshot at ``path`` and return the row count."""
+
+    with SnapshotWriter(path, columns, metadata) as writer:
+        writer.write(rows)
+    return writer.row_count
+
+
+def read_snapshot(path: str) -> tuple[dict, list[tuple]]:
+    """Return the metadata and rows of the snapshot at ``path``."""
+
+    with SnapshotReader(path) as reader:
+        return reader.metadata, list(reader)
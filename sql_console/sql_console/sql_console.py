@@ -1,7 +1,43 @@
+import contextlib
+import math
+import threading
+import time
+
+
+# a budget-derived timeout shrinks on every call; it is applied to the session
+# this many seconds (or this fraction) short, so the next calls can reuse it
+# without ever running past what is left of the budget
+TIMEOUT_RESET_SECONDS = 1.0
+TIMEOUT_RESET_RATIO = 0.1
+
+
 class SqlWrapperConnectionError(Exception):
     pass
 
 
+class SqlWrapperTimeoutError(Exception):
+    pass
+
+
+class LatencyBudget():
+    """Wall-clock budget shared by every call made on behalf of one job.
+
+    Pass the same instance as the 'budget' parameter to several SqlWrapper
+    connections (or to individual query/proc calls); each call is then limited
+    to whatever is left of the budget.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
 class SqlWrapper():
 
     def __init__(self, param):
@@ -16,10 +52,37 @@ class SqlWrapper():
         self.debug = param['debug']
         self.format = param['format']
         self.method = param['method']
+        self.timeout = param.get('timeout')
+        self.connect_timeout = param.get('connect_timeout')
+        self.budget = param.get('budget')
+        self._session_timeout = None
+        self.last_queue_wait = 0.0
+        self.binary = param.get('binary', False)
+
+        # optional cross-process limit on concurrent queries against this server
+        self.admission = None
+        if param.get('admission'):
+            from .admission import admission_controller
+            self.admission = admission_controller(self.env, self.server, param['admission'])
 
         if self.server not in db[self.env]:
             db[self.env][self.server] = self.server
 
+        # native connect/read timeouts for each driver
+        odbc_timeout = {'timeout': int(math.ceil(self.connect_timeout))} if self.connect_timeout else {}
+        mssql_timeout = {}
+        mysql_timeout = {}
+        pg_timeout = {}
+        if self.connect_timeout:
+            mssql_timeout['login_timeout'] = int(math.ceil(self.connect_timeout))
+            mysql_timeout['connect_timeout'] = int(math.ceil(self.connect_timeout))
+            pg_timeout['connect_timeout'] = max(int(math.ceil(self.connect_timeout)), 2)
+        if self.timeout:
+            mssql_timeout['timeout'] = int(math.ceil(self.timeout))
+            mysql_timeout['read_timeout'] = int(math.ceil(self.timeout))
+            mysql_timeout['write_timeout'] = int(math.ceil(self.timeout))
+            pg_timeout['options'] = '-c statement_timeout=' + str(int(self.timeout * 1000))
+
         self.c = {self.env: {}}
         try:
             if self.debug:
@@ -28,14 +91,14 @@ class SqlWrapper():
                 try:
                     if 'credentials' in param:
                         if 'db' in param:
-                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={SQL Server};SERVER=' + db[self.env][self.server] + ';PORT=1443;UID=APEXCLEARING\\' + param['credentials']['user'] + ';PWD=' + param['credentials']['password'] + ';DATABASE=' + param['db'] + ';trusted_connection=yes', autocommit=True)
+                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={SQL Server};SERVER=' + db[self.env][self.server] + ';PORT=1443;UID=APEXCLEARING\\' + param['credentials']['user'] + ';PWD=' + param['credentials']['password'] + ';DATABASE=' + param['db'] + ';trusted_connection=yes', autocommit=True, **odbc_timeout)
                         else:
-                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={SQL Server};SERVER=' + db[self.env][self.server] + ';PORT=1443;UID=APEXCLEARING\\' + param['credentials']['user'] + ';PWD=' + param['credentials']['password'] + ';trusted_connection=yes', autocommit=True)
+                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={SQL Server};SERVER=' + db[self.env][self.server] + ';PORT=1443;UID=APEXCLEARING\\' + param['credentials']['user'] + ';PWD=' + param['credentials']['password'] + ';trusted_connection=yes', autocommit=True, **odbc_timeout)
                     else:
                         if 'db' in param:
-                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={SQL Server};SERVER=' + db[self.env][self.server] + ';PORT=1443;DATABASE=' + param['db'] + ';trusted_connection=yes', autocommit=True)
+                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={SQL Server};SERVER=' + db[self.env][self.server] + ';PORT=1443;DATABASE=' + param['db'] + ';trusted_connection=yes', autocommit=True, **odbc_timeout)
                         else:
-                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={SQL Server};SERVER=' + db[self.env][self.server] + ';PORT=1443;trusted_connection=yes', autocommit=True)
+                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={SQL Server};SERVER=' + db[self.env][self.server] + ';PORT=1443;trusted_connection=yes', autocommit=True, **odbc_timeout)
                 except pyodbc.Error as pyodbcerr:
                     if self.debug:
                         print('SqlWrapper.init.pyodbc: error: could not connect to ' + db[self.env][self.server] + ': message: ' + str(pyodbcerr))
@@ -43,28 +106,35 @@ class SqlWrapper():
                     # linux workaround for connecting to SQL server via pyodbc and FreeTDS
                     try:
                         if 'credentials' in param:
-                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={FreeTDS};SERVER=' + db[self.env][self.server] + ';UID=APEXCLEARING\\' + param['credentials']['user'] + ';PWD=' + param['credentials']['password'] + ';trusted_connection=yes')
+                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={FreeTDS};SERVER=' + db[self.env][self.server] + ';UID=APEXCLEARING\\' + param['credentials']['user'] + ';PWD=' + param['credentials']['password'] + ';trusted_connection=yes', **odbc_timeout)
                         else:
-                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={FreeTDS};SERVER=' + db[self.env][self.server] + ';trusted_connection=yes')
+                            self.c[self.env][self.server] = pyodbc.connect('DRIVER={FreeTDS};SERVER=' + db[self.env][self.server] + ';trusted_connection=yes', **odbc_timeout)
                     except pyodbc.Error as pyodbcerr:
                         raise SqlWrapperConnectionError('SqlWrapper.init.pyodbc: error: could not connect to ' + db[self.env][self.server] + ' with user ' + param['credentials']['user'] + ': message: ' + str(pyodbcerr))
 
             elif self.method == 'dsn':
-                self.c[self.env][self.server] = pyodbc.connect('DSN=' + self.server + ';UID=' + param['credentials']['user'] + ';PWD=' + param['credentials']['password'] + ';trusted_connection=yes')
+                self.c[self.env][self.server] = pyodbc.connect('DSN=' + self.server + ';UID=' + param['credentials']['user'] + ';PWD=' + param['credentials']['password'] + ';trusted_connection=yes', **odbc_timeout)
             elif self.method == 'pymssql':
                 if 'db' in param:
-                    self.c[self.env][self.server] = pymssql.connect(server=db[self.env][self.server], user='APEXCLEARING\\'+param['credentials']['user'], password=param['credentials']['password'], database=param['db'], autocommit=True)
+                    self.c[self.env][self.server] = pymssql.connect(server=db[self.env][self.server], user='APEXCLEARING\\'+param['credentials']['user'], password=param['credentials']['password'], database=param['db'], autocommit=True, **mssql_timeout)
                 else:
-                    self.c[self.env][self.server] = pymssql.connect(server=db[self.env][self.server], user='APEXCLEARING\\' + param['credentials']['user'], password=param['credentials']['password'], autocommit=True)
+                    self.c[self.env][self.server] = pymssql.connect(server=db[self.env][self.server], user='APEXCLEARING\\' + param['credentials']['user'], password=param['credentials']['password'], autocommit=True, **mssql_timeout)
             elif self.method == 'pymysql':
-                self.c[self.env][self.server] = pymysql.connect(host=db[self.env][self.server], user=param['credentials']['user'], password=param['credentials']['password'], autocommit=True)
+                self.c[self.env][self.server] = pymysql.connect(host=db[self.env][self.server], user=param['credentials']['user'], password=param['credentials']['password'], autocommit=True, **mysql_timeout)
             #elif self.method == 'mysqlclient':
                 #self.c[self.env][self.server] = myc.connect(param['credentials']['user'], param['credentials']['password'], host=db[self.env][self.server], buffered=True)
             elif self.method == 'psycopg2':
                 if 'credentials' in param:
-                    self.c[self.env][self.server] = psycopg2.connect(dbname=param['db'], user=param['credentials']['user'], password=param['credentials']['password'], host=db[self.env][self.server], port=5432)
+                    self.c[self.env][self.server] = psycopg2.connect(dbname=param['db'], user=param['credentials']['user'], password=param['credentials']['password'], host=db[self.env][self.server], port=5432, **pg_timeout)
                 else:
-                    self.c[self.env][self.server] = psycopg2.connect(dbname=param['db'], user=param['credentials']['user'], password=param['credentials']['password'], host=db[self.env][self.server], port=5432)
+                    self.c[self.env][self.server] = psycopg2.connect(dbname=param['db'], user=param['credentials']['user'], password=param['credentials']['password'], host=db[self.env][self.server], port=5432, **pg_timeout)
+            elif self.method == 'psycopg':
+                # psycopg 3 is optional, only import it when asked for
+                import psycopg
+                try:
+                    self.c[self.env][self.server] = psycopg.connect(dbname=param['db'], user=param['credentials']['user'], password=param['credentials']['password'], host=db[self.env][self.server], port=5432, autocommit=True, prepare_threshold=param.get('prepare_threshold', 5), **pg_timeout)
+                except psycopg.Error as psycopgerr:
+                    raise SqlWrapperConnectionError('SqlWrapper.init.psycopg: error: could not connect to ' + db[self.env][self.server] + ' with user ' + param['credentials']['user'] + ': message: ' + str(psycopgerr))
         except pyodbc.Error as PyPyODBC:
             raise SqlWrapperConnectionError('SqlWrapper.init.pyodbc: error: could not connect to ' + db[self.env][self.server] + ' with user ' + param['credentials']['user'] + ': message: ' + str(PyPyODBC))
         except pymssql.Error as sqlerror:
@@ -77,6 +147,10 @@ class SqlWrapper():
         except psycopg2.Error as psycopg2err:
             raise SqlWrapperConnectionError('SqlWrapper.init.psycopg2: error: could not connect to ' + db[self.env][self.server] + ' with user ' +param['credentials']['user'] + ': message: ' + str(psycopg2err))
 
+        # psycopg already applied the connection timeout through libpq 'options'
+        if self.method in ['psycopg2', 'psycopg']:
+            self._session_timeout = self.timeout
+
         # call autocommit method for certain connection methods
         if self.method not in ['pymssql', 'pymysql']:
             self.c[self.env][self.server].autocommit = True
@@ -86,6 +160,8 @@ class SqlWrapper():
             self.cursor = self.c[self.env][self.server].cursor(pymysql.cursors.DictCursor)
         elif self.method == 'pymssql':
             self.cursor = self.c[self.env][self.server].cursor(as_dict=True)
+        elif self.method == 'psycopg':
+            self.cursor = self.c[self.env][self.server].cursor(binary=self.binary)
         else:
             self.cursor = self.c[self.env][self.server].cursor()
 
@@ -98,34 +174,189 @@ class SqlWrapper():
         column_names = [column[0] for column in description]
         return [dict(zip(column_names, row)) for row in rows]
 
+    def _call_timeout(self, param):
+        """Return the timeout in seconds for one call, honouring any latency budget."""
+        timeout = param.get('timeout', self.timeout)
+        budget = param.get('budget', self.budget)
+        if budget is not None:
+            remaining = budget.remaining()
+            if remaining <= 0:
+                raise SqlWrapperTimeoutError('SqlWrapper: error: latency budget of ' + str(budget.seconds) + 's exhausted before executing on ' + self.server)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def _set_timeout(self, timeout):
+        """Apply a statement timeout to the session through the driver's native mechanism.
+
+        The session timeout never exceeds ``timeout``: a shorter one left by an
+        earlier call is kept while it is within the reset margin, and a timeout
+        shorter than the session's is applied with that margin taken off.
+        """
+        if timeout == self._session_timeout:
+            return
+        if timeout and self._session_timeout:
+            margin = min(max(TIMEOUT_RESET_SECONDS, timeout * TIMEOUT_RESET_RATIO), timeout / 2)
+            if timeout - margin <= self._session_timeout <= timeout:
+                return
+            if timeout < self._session_timeout:
+                timeout -= margin
+
+        if self.method in ['psycopg2', 'psycopg']:
+            self.cursor.execute('SET statement_timeout = ' + str(int(math.ceil(timeout * 1000)) if timeout else 0))
+        elif self.method in ['pyodbc', 'dsn']:
+            # whole seconds only, round down so the timeout stays within the budget
+            if timeout:
+                timeout = max(int(timeout), 1)
+            conn = self.c[self.env][self.server]
+            conn.timeout = timeout or 0
+            # pyodbc copies the connection timeout into a cursor only when the cursor is created
+            self.cursor.close()
+            self.cursor = conn.cursor()
+        elif self.method == 'pymysql':
+            # only applies to SELECT on MySQL 5.7+; read_timeout set at connect covers the rest
+            try:
+                self.cursor.execute('SET SESSION MAX_EXECUTION_TIME = ' + str(int(math.ceil(timeout * 1000)) if timeout else 0))
+            except Exception as cerr:
+                if self.debug:
+                    print('SqlWrapper: info: MAX_EXECUTION_TIME not supported, relying on read_timeout: ' + str(cerr))
+        # pymssql has no per-statement timeout, _deadline cancels the call instead
+        self._session_timeout = timeout
+
+    def _is_timeout(self, err):
+        if self.method == 'psycopg2':
+            import psycopg2.extensions
+            return isinstance(err, psycopg2.extensions.QueryCanceledError)
+        elif self.method == 'psycopg':
+            import psycopg.errors
+            return isinstance(err, psycopg.errors.QueryCanceled)
+        elif self.method in ['pyodbc', 'dsn']:
+            return len(err.args) > 0 and err.args[0] in ['HYT00', 'HYT01']
+        elif self.method == 'pymysql':
+            # 3024: MAX_EXECUTION_TIME exceeded, 2013: lost connection (read_timeout)
+            return len(err.args) > 0 and err.args[0] in [2013, 3024]
+        elif self.method == 'pymssql':
+            return 'timed out' in str(err).lower() or '20003' in str(err)
+        return False
+
+    @contextlib.contextmanager
+    def _deadline(self, param, statement=None):
+        """Run the enclosed statement under the call timeout, raising SqlWrapperTimeoutError when it expires.
+
+        When admission control is enabled and a statement is given, a slot on the
+        server is held until the block exits, so fetch its results inside it.
+        Yields the admission ticket, or None.
+        """
+        timeout = self._call_timeout(param)
+
+        ticket = None
+        if self.admission is not None and statement is not None:
+            ticket = self.admission.acquire(timeout)
+            self.last_queue_wait = ticket.wait_seconds
+            if self.debug and ticket.wait_seconds >= 1:
+                print('SqlWrapper: info: queued ' + str(round(ticket.wait_seconds, 1)) + 's for a slot on ' + self.server)
+            if timeout is not None:
+                timeout = max(timeout - ticket.wait_seconds, 0.001)
+
+        watchdog = None
+        congested = None
+        try:
+            self._set_timeout(timeout)
+            if timeout and self.method == 'pymssql':
+                watchdog = threading.Timer(timeout, self.cancel)
+                watchdog.daemon = True
+                watchdog.start()
+            yield ticket
+        except Exception as err:
+            if self._is_timeout(err) or (watchdog is not None and watchdog.finished.is_set()):
+                congested = True
+                raise SqlWrapperTimeoutError('SqlWrapper: error: statement on ' + self.server + ' exceeded timeout of ' + str(timeout) + 's: message: ' + str(err)) from err
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if ticket is not None:
+                self.admission.release(ticket, key=param.get('admission_key'), congested=congested, statement=statement)
+
+    def cancel(self):
+        """Cancel the statement currently running on this connection; safe to call from another thread."""
+        try:
+            if self.method in ['psycopg2', 'psycopg']:
+                self.c[self.env][self.server].cancel()
+            elif self.method in ['pyodbc', 'dsn']:
+                self.cursor.cancel()
+            elif self.method == 'pymssql':
+                self.c[self.env][self.server]._conn.cancel()
+            else:
+                if self.debug:
+                    print('SqlWrapper.cancel: error: method "' + self.method + '" does not support cancel')
+                return False
+        except Exception as cerr:
+            if self.debug:
+                print('SqlWrapper.cancel: error: cancel failed: ' + str(cerr))
+            return False
+        return True
+
     def __exit__(self):
         self.c[self.env][self.server].close()
 
     def close(self):
         self.c[self.env][self.server].close()
 
+    def _results(self, param):
+        if self.method in ['psycopg2', 'psycopg']:
+            # description method will be None if the query does not return results
+            if self.cursor.description is None:
+                return True
+            else:
+                if param['results'] is True:
+                    return self.cursor.fetchall()
+                else:
+                    return True
+
+        # TODO: cheating with ''dict' in param' because current code is not compatible - should be 'param['dict'] is True'
+        # https://stackoverflow.com/a/27422384/2237552
+        elif self.method == 'pyodbc' and 'dict' in param:
+            if param['results'] is True:
+                return self._rows_to_dicts(self.cursor.fetchall())
+            else:
+                return True
+        else:
+            if param['results'] is True:
+                return self.cursor.fetchall()
+            else:
+                return True
+
     def query(self, param):
         if 'db' in param:
             if self.debug:
                 print('SqlWrapper.query: info: switching database to "' + param['db'] + '"')
             try:
-                self.cursor.execute('USE ' + param['db'])
+                with self._deadline(param):
+                    self.cursor.execute('USE ' + param['db'])
+            except SqlWrapperTimeoutError:
+                raise
             except self.cursor.Error as cerr:
                 if self.debug:
                     print('SqlWrapper.query: error: query failed: ' + str(cerr))
                 return False
 
         if 'results' in param:
-            if isinstance(param['query'], list):
+            if isinstance(param['query'], list) and self.method == 'psycopg' and param.get('pipeline'):
+                return self._pipeline(param)
+
+            elif isinstance(param['query'], list):
                 output = []
                 for q in param['query']:
                     try:
-                        self.cursor.execute(q)
+                        with self._deadline(param, q):
+                            self.cursor.execute(q)
+                            output.append([i[0] for i in self.cursor.fetchall()])
+                    except SqlWrapperTimeoutError:
+                        raise
                     except Exception as cerr:
                         if self.debug:
                             print('SqlWrapper.query: error: query failed: ' + str(cerr))
                         return False
-                    output.append([i[0] for i in self.cursor.fetchall()])
                 if param['results'] is True:
                     return output
                 else:
@@ -135,36 +366,21 @@ class SqlWrapper():
                 if self.debug:
                     print('SqlWrapper.query: info: executing query')
 
+                # results are fetched inside the deadline so an admission slot covers the fetch
                 try:
-                    self.cursor.execute(param['query'])
+                    with self._deadline(param, param['query']):
+                        if self.method == 'psycopg':
+                            self.cursor.execute(param['query'], param.get('params'), prepare=param.get('prepare'))
+                        else:
+                            self.cursor.execute(param['query'])
+                        return self._results(param)
+                except SqlWrapperTimeoutError:
+                    raise
                 except Exception as cerr:
                     if self.debug:
                         print('SqlWrapper.query: error: query failed: ' + str(cerr))
                     return False
 
-                if self.method == 'psycopg2':
-                    # description method will be None if the query does not return results
-                    if self.cursor.description is None:
-                        return True
-                    else:
-                        if param['results'] is True:
-                            return self.cursor.fetchall()
-                        else:
-                            return True
-
-                # TODO: cheating with ''dict' in param' because current code is not compatible - should be 'param['dict'] is True'
-                # https://stackoverflow.com/a/27422384/2237552
-                elif self.method == 'pyodbc' and 'dict' in param:
-                    if param['results'] is True:
-                        return self._rows_to_dicts(self.cursor.fetchall())
-                    else:
-                        return True
-                else:
-                    if param['results'] is True:
-                        return self.cursor.fetchall()
-                    else:
-                        return True
-
             else:
                 if self.debug:
                     print('SqlWrapper.query: error: "query" parameter invalid, expecting list or string')
@@ -174,6 +390,278 @@ class SqlWrapper():
                 print('SqlWrapper.query: error: expecting "results" parameter')
             return False
 
+    def iter_query(self, param):
+        """Stream the rows of param['query'] instead of fetching them all at once.
+
+        Rows are fetched param['fetch_size'] at a time (default 1000); fetch_size
+        may also be a callable returning the size to use for the next batch.
+        Returns an iterator over the rows, or False if the query failed. Any
+        admission slot is held until the iterator is exhausted or closed.
+        """
+        if self.debug:
+            print('SqlWrapper.iter_query: info: executing query')
+        rows = self._iter_rows(param)
+        if next(rows) is False:
+            return False
+        return rows
+
+    def _iter_rows(self, param):
+        # yields True (or False if the query failed) once executed, then the rows
+        fetch_size = param.get('fetch_size', 1000)
+        executed = False
+        try:
+            with self._deadline(param, param['query']) as ticket:
+                self.cursor.execute(param['query'])
+                executed = True
+                yield True
+                if self.cursor.description is None:
+                    return
+                while True:
+                    rows = self.cursor.fetchmany(fetch_size() if callable(fetch_size) else fetch_size)
+                    if not rows:
+                        return
+                    handed_over = time.monotonic()
+                    yield from rows
+                    if ticket is not None:
+                        # time spent by the consumer is not query latency
+                        ticket.idle += time.monotonic() - handed_over
+        except SqlWrapperTimeoutError:
+            raise
+        except Exception as cerr:
+            if executed:
+                raise
+            if self.debug:
+                print('SqlWrapper.iter_query: error: query failed: ' + str(cerr))
+            yield False
+
+    def _pipeline(self, param):
+        """Send every statement in param['query'] before reading any result (psycopg 3 pipeline mode).
+
+        The statements run in one transaction, so a failure rolls back the whole
+        list. With 'results': True, returns one entry per statement: its rows,
+        or True when it returned none.
+        """
+        conn = self.c[self.env][self.server]
+        cursors = []
+        if self.debug:
+            print('SqlWrapper.query: info: pipelining ' + str(len(param['query'])) + ' queries')
+        try:
+            with self._deadline(param, ';'.join(param['query'])):
+                with conn.pipeline(), conn.transaction():
+                    for q in param['query']:
+                        cursor = conn.cursor(binary=self.binary)
+                        cursor.execute(q, prepare=param.get('prepare'))
+                        cursors.append(cursor)
+                if param['results'] is True:
+                    return [cursor.fetchall() if cursor.description is not None else True for cursor in cursors]
+                return True
+        except SqlWrapperTimeoutError:
+            raise
+        except Exception as cerr:
+            if self.debug:
+                print('SqlWrapper.query: error: pipeline failed: ' + str(cerr))
+            return False
+
+    def copy(self, param):
+        """Bulk load param['rows'] into param['table'] with COPY (psycopg 3 only).
+
+        When param['types'] lists the Postgres type of each column the binary
+        COPY format is used, otherwise text. Returns True, or False on failure.
+        """
+        if self.method != 'psycopg':
+            if self.debug:
+                print('SqlWrapper.copy: error: method "' + self.method + '" is not supported')
+            return False
+
+        statement = 'COPY ' + param['table'] + ' (' + ', '.join(param['columns']) + ') FROM STDIN'
+        if param.get('types'):
+            statement += ' (FORMAT BINARY)'
+        if self.debug:
+            print('SqlWrapper.copy: info: ' + statement)
+
+        try:
+            with self._deadline(param, statement):
+                with self.cursor.copy(statement) as copy:
+                    if param.get('types'):
+                        copy.set_types(param['types'])
+                    for row in param['rows']:
+                        copy.write_row(row)
+        except SqlWrapperTimeoutError:
+            raise
+        except Exception as cerr:
+            if self.debug:
+                print('SqlWrapper.copy: error: copy failed: ' + str(cerr))
+            return False
+        return True
+
+    def _set_autocommit(self, value):
+        if self.method == 'pymssql':
+            self.c[self.env][self.server].autocommit(value)
+        else:
+            self.c[self.env][self.server].autocommit = value
+
+    def _execute_bulk(self, param, statement, rows):
+        """Send one batch of rows into the staging table with the fastest path the driver has."""
+        if param.get('tvp'):
+            # the TVP is sent as a single parameter: [type name, schema, rows...]
+            schema, _, type_name = param['tvp'].rpartition('.')
+            with self._deadline(param, statement):
+                self.cursor.execute(statement, ([type_name, schema or 'dbo'] + rows,))
+        elif self.method == 'pymssql':
+            # pymssql has no array binding, so send multi-row VALUES (at most 1000 rows per INSERT)
+            row_marker = '(' + ', '.join(['%s'] * len(param['columns'])) + ')'
+            for start in range(0, len(rows), 1000):
+                chunk = rows[start:start + 1000]
+                chunk_statement = statement + ', '.join([row_marker] * len(chunk))
+                with self._deadline(param, statement):
+                    self.cursor.execute(chunk_statement, tuple(value for row in chunk for value in row))
+        else:
+            with self._deadline(param, statement):
+                # set inside _deadline, which opens a new cursor when it changes the timeout
+                self.cursor.fast_executemany = param.get('fast_executemany', True)
+                if param.get('input_sizes'):
+                    self.cursor.setinputsizes(param['input_sizes'])
+                self.cursor.executemany(statement, rows)
+
+    def _identity_column(self, param):
+        """Return the name of the IDENTITY column of param['table'] when the load supplies it, else None."""
+        statement = "SELECT name FROM sys.identity_columns WHERE object_id = OBJECT_ID('" + param['table'].replace("'", "''") + "')"
+        with self._deadline(param, statement):
+            self.cursor.execute(statement)
+            row = self.cursor.fetchone()
+        if row is None:
+            return None
+        name = row['name'] if isinstance(row, dict) else row[0]
+        supplied = [c.strip('[]').lower() for c in param['columns']]
+        return name if name.lower() in supplied else None
+
+    def _merge_statement(self, param, staging):
+        columns = param['columns']
+        key = param.get('key')
+        if not key:
+            return 'INSERT INTO ' + param['table'] + ' (' + ', '.join(columns) + ') SELECT ' + ', '.join(columns) + ' FROM ' + staging
+
+        update = param.get('update', [c for c in columns if c not in key])
+        statement = 'MERGE INTO ' + param['table'] + ' WITH (HOLDLOCK) AS t USING ' + staging + ' AS s ON ' + ' AND '.join('t.' + c + ' = s.' + c for c in key)
+        if update:
+            # EXCEPT compares NULLs as equal, so unchanged rows are not rewritten
+            statement += ' WHEN MATCHED AND EXISTS (SELECT ' + ', '.join('s.' + c for c in update) + ' EXCEPT SELECT ' + ', '.join('t.' + c for c in update) + ')'
+            statement += ' THEN UPDATE SET ' + ', '.join('t.' + c + ' = s.' + c for c in update)
+        statement += ' WHEN NOT MATCHED BY TARGET THEN INSERT (' + ', '.join(columns) + ') VALUES (' + ', '.join('s.' + c for c in columns) + ')'
+        if param.get('delete'):
+            statement += ' WHEN NOT MATCHED BY SOURCE THEN DELETE'
+        return statement + ';'
+
+    def bulk_load(self, param):
+        """Bulk load param['rows'] into param['table'] on SQL Server through a staging table.
+
+        Rows are sent to the staging table param['batch_size'] at a time (default
+        10000): as table-valued parameters when param['tvp'] names a table type
+        with the staging table's columns, otherwise with pyodbc fast_executemany
+        (multi-row INSERTs on pymssql). The staging rows are committed every
+        param['commit_size'] rows, then merged into the table in one set-based
+        MERGE on the param['key'] columns, updating param['update'] (default:
+        every non-key column) and, with 'delete': True, deleting target rows
+        missing from the load. Without a key the staging rows are appended.
+
+        param['staging'] defaults to a #temp table created from the table's
+        columns, without their IDENTITY property; a permanent staging table
+        must already exist and is truncated. When the load supplies the
+        table's IDENTITY column, IDENTITY_INSERT is on for the merge.
+        Returns the number of rows loaded, or False on failure.
+        """
+        if self.method not in ['pyodbc', 'dsn', 'pymssql']:
+            if self.debug:
+                print('SqlWrapper.bulk_load: error: method "' + self.method + '" is not supported')
+            return False
+        if param.get('tvp') and self.method == 'pymssql':
+            if self.debug:
+                print('SqlWrapper.bulk_load: error: table-valued parameters need pyodbc')
+            return False
+
+        columns = param['columns']
+        batch_size = param.get('batch_size', 10000)
+        commit_size = max(param.get('commit_size', 100000), batch_size)
+        staging = param.get('staging', '#' + param['table'].replace('[', '').replace(']', '').split('.')[-1] + '_staging')
+
+        if staging.startswith('#'):
+            prepare = ["IF OBJECT_ID('tempdb.." + staging + "') IS NOT NULL DROP TABLE " + staging,
+                       # the join keeps SELECT INTO from copying the IDENTITY property
+                       'SELECT TOP 0 ' + ', '.join(columns) + ' INTO ' + staging + ' FROM ' + param['table']
+                       + ' LEFT JOIN (SELECT 1 AS no_identity) AS no_identity ON 1 = 0']
+        else:
+            prepare = ['TRUNCATE TABLE ' + staging]
+
+        if param.get('tvp'):
+            insert = 'INSERT INTO ' + staging + ' (' + ', '.join(columns) + ') SELECT * FROM ?'
+        elif self.method == 'pymssql':
+            insert = 'INSERT INTO ' + staging + ' (' + ', '.join(columns) + ') VALUES '
+        else:
+            insert = 'INSERT INTO ' + staging + ' (' + ', '.join(columns) + ') VALUES (' + ', '.join(['?'] * len(columns)) + ')'
+
+        merge = self._merge_statement(param, staging)
+        if self.debug:
+            print('SqlWrapper.bulk_load: info: loading ' + param['table'] + ' through ' + staging + ' in batches of ' + str(batch_size))
+
+        loaded = 0
+        uncommitted = 0
+        identity_insert = False
+        self._set_autocommit(False)
+        try:
+            if self._identity_column(param) is not None:
+                prepare.append('SET IDENTITY_INSERT ' + param['table'] + ' ON')
+                identity_insert = True
+            for statement in prepare:
+                with self._deadline(param, statement):
+                    self.cursor.execute(statement)
+
+            rows = iter(param['rows'])
+            while True:
+                batch = [tuple(row) for _, row in zip(range(batch_size), rows)]
+                if not batch:
+                    break
+                self._execute_bulk(param, insert, batch)
+                loaded += len(batch)
+                uncommitted += len(batch)
+                if uncommitted >= commit_size:
+                    self.c[self.env][self.server].commit()
+                    uncommitted = 0
+                    if self.debug:
+                        print('SqlWrapper.bulk_load: info: staged ' + str(loaded) + ' rows')
+
+            with self._deadline(param, merge):
+                self.cursor.execute(merge)
+            if staging.startswith('#'):
+                self.cursor.execute('DROP TABLE ' + staging)
+            self.c[self.env][self.server].commit()
+        except Exception as cerr:
+            try:
+                self.c[self.env][self.server].rollback()
+            except Exception:
+                pass
+            if isinstance(cerr, SqlWrapperTimeoutError):
+                raise
+            if self.debug:
+                print('SqlWrapper.bulk_load: error: bulk load failed after ' + str(loaded) + ' rows: ' + str(cerr))
+            return False
+        finally:
+            if identity_insert:
+                # a session setting, not undone by the rollback
+                try:
+                    self.cursor.execute('SET IDENTITY_INSERT ' + param['table'] + ' OFF')
+                except Exception:
+                    pass
+            if self.method != 'pymssql':
+                self.cursor.fast_executemany = False
+                if param.get('input_sizes'):
+                    # the cursor is shared, later queries must not inherit the sizes
+                    self.cursor.setinputsizes(None)
+            self._set_autocommit(True)
+
+        if self.debug:
+            print('SqlWrapper.bulk_load: info: merged ' + str(loaded) + ' rows into ' + param['table'])
+        return loaded
+
     def proc(self, param):
         import pymssql, pyodbc
 
@@ -181,8 +669,9 @@ class SqlWrapper():
             try:
                 if self.debug:
                     print('SqlWrapper.proc: executing query: {CALL ' + param['proc'] + ' (' + str(''.join(['?,' for i in param['params']]))[:-1] + ')}, ' + str(param['params']))
-                self.cursor.execute('{CALL ' + param['proc'] + ' (' + str(''.join(['?,' for i in param['params']]))[:-1] + ')}', param['params'])
-                return self._rows_to_dicts(self.cursor.fetchall())
+                with self._deadline(param, param['proc']):
+                    self.cursor.execute('{CALL ' + param['proc'] + ' (' + str(''.join(['?,' for i in param['params']]))[:-1] + ')}', param['params'])
+                    return self._rows_to_dicts(self.cursor.fetchall())
             except pyodbc.Error as cerr:
                 if self.debug:
                     print('SqlWrapper.proc: error: proc failed: ' + str(cerr))
@@ -191,13 +680,14 @@ class SqlWrapper():
         #TODO: pymssql callproc is not working correctly - not sure why
         elif self.method == 'pymssql':
             try:
-                self.cursor.callproc(param['proc'], param['params'])
-                results = self.cursor.fetchall()
-                while results:
-                    if self.cursor.nextset():
-                        results.append(self.cursor.fetchall())
-                    else:
-                        return results
+                with self._deadline(param, param['proc']):
+                    self.cursor.callproc(param['proc'], param['params'])
+                    results = self.cursor.fetchall()
+                    while results:
+                        if self.cursor.nextset():
+                            results.append(self.cursor.fetchall())
+                        else:
+                            return results
             except pymssql.Error as cerr:
                 if self.debug:
                     print('SqlWrapper.proc: error: proc failed: ' + str(cerr))
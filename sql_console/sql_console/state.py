@@ -0,0 +1,355 @@
+"""Local state store for detecting unchanged source loads.
+
+Loaders such as ``tator.py`` and ``tidal_to_grafana_v2.py`` are frequently
+re-run with the same source results as the last successful load.  The
+:class:`LoadStateStore` records a streaming digest of each committed load so
+that a rerun can skip the destination entirely, or apply only the chunks whose
+digest changed.
+
+It also keeps the incremental extraction watermark (the last synced
+change-tracking value) for each job and origin, cached copies of small
+lookup tables, and a fingerprint of what was loaded for each day of a
+precomputed schedule so that only changed days are regenerated.
+
+The store is a SQLite file on the batch host; no external service is needed.
+"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import json
+import itertools
+import sqlite3
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from typing import NamedTuple
+
+
+class LoadState(NamedTuple):
+    """The last committed load recorded for a state key."""
+
+    digest: str
+    chunk_size: int
+    chunk_digests: list[str]
+    row_count: int
+    committed_at: str
+
+
+class Watermark(NamedTuple):
+    """The last synced change-tracking value for a job and origin."""
+
+    kind: str
+    value: str
+    last_full_sync: str | None
+    updated_at: str
+
+
+def _encode_row(row: object) -> bytes:
+    """Return a stable byte encoding of ``row`` for hashing.
+
+    Driver row objects (``pyodbc.Row``, tuples, lists) are normalised to a
+    list of ``repr`` values so that the same result set hashes identically
+    regardless of the driver that produced it.
+    """
+
+    if isinstance(row, (str, bytes)) or not isinstance(row, Iterable):
+        values = [row]
+    else:
+        values = list(row)
+    return ("\x1f".join(repr(value) for value in values) + "\x1e").encode("utf-8")
+
+
+class ResultDigest:
+    """Streaming SHA-256 digest of a result set, with optional chunk digests.
+
+    Rows are fed one at a time through :meth:`update`.  When ``chunk_size`` is
+    positive, an additional digest is kept for every ``chunk_size`` rows so
+    that a subsequent load can be compared chunk by chunk.
+    """
+
+    def __init__(self, chunk_size: int = 0) -> None:
+        self.chunk_size = max(chunk_size, 0)
+        self.row_count = 0
+        self.chunk_digests: list[str] = []
+        self._digest = hashlib.sha256()
+        self._chunk = hashlib.sha256()
+
+    def update(self, row: object) -> None:
+        encoded = _encode_row(row)
+        self._digest.update(encoded)
+        self.row_count += 1
+
+        if self.chunk_size:
+            self._chunk.update(encoded)
+            if self.row_count % self.chunk_size == 0:
+                self.chunk_digests.append(self._chunk.hexdigest())
+                self._chunk = hashlib.sha256()
+
+    def finish(self) -> ResultDigest:
+        """Close the trailing partial chunk, if any, and return ``self``."""
+
+        if self.chunk_size and self.row_count % self.chunk_size:
+            self.chunk_digests.append(self._chunk.hexdigest())
+            self._chunk = hashlib.sha256()
+        return self
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+    def chunk_of(self, row_index: int) -> int:
+        """Return the chunk number that ``row_index`` falls in."""
+
+        if not self.chunk_size:
+            return 0
+        return row_index // self.chunk_size
+
+    def changed_chunks(self, previous: LoadState | None) -> set[int]:
+        """Return the chunk numbers that differ from ``previous``.
+
+        Every chunk is considered changed when there is no previous load or
+        the previous load used a different chunk size.
+        """
+
+        if not self.chunk_size:
+            return {0} if previous is None or previous.digest != self.hexdigest() else set()
+
+        return {index for index in range(len(self.chunk_digests)) if self.chunk_changed(index, previous)}
+
+    def chunk_changed(self, index: int, previous: LoadState | None) -> bool:
+        """Whether finished chunk ``index`` differs from the same chunk of ``previous``."""
+
+        if previous is None or previous.chunk_size != self.chunk_size or index >= len(previous.chunk_digests):
+            return True
+        return previous.chunk_digests[index] != self.chunk_digests[index]
+
+
+def digest_rows(rows: Iterable[object], chunk_size: int = 0) -> ResultDigest:
+    """Return the finished :class:`ResultDigest` of ``rows``."""
+
+    digest = ResultDigest(chunk_size)
+    for row in rows:
+        digest.update(row)
+    return digest.finish()
+
+
+def changed_batches(
+    rows: Iterable[object],
+    digest: ResultDigest,
+    previous: LoadState | None,
+    batch_size: int | Callable[[], int],
+) -> Iterator[list]:
+    """Feed ``rows`` through ``digest`` and yield the batches that need loading.
+
+    For streaming a load that is too large to collect first.  With chunk
+    digests, rows are grouped into the digest's chunks and only the chunks
+    that differ from ``previous`` are yielded, so memory is bounded by the
+    chunk size.  Without, an unchanged load cannot be detected until its last
+    row, so every row is yielded, ``batch_size`` rows at a time.  ``digest``
+    is finished once the rows are exhausted.
+    """
+
+    iterator = iter(rows)
+    while True:
+        if digest.chunk_size:
+            size = digest.chunk_size
+        else:
+            size = batch_size() if callable(batch_size) else batch_size
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            break
+        for row in batch:
+            digest.update(row)
+
+        if not digest.chunk_size:
+            yield batch
+            continue
+        if len(batch) < size:
+            # the trailing partial chunk
+            digest.finish()
+        if digest.chunk_changed(len(digest.chunk_digests) - 1, previous):
+            yield batch
+        if len(batch) < size:
+            return
+
+    digest.finish()
+
+
+def state_key(job: str, origin: str | None, query: str, parameters: Sequence[str] | str | None) -> str:
+    """Return the key a load is recorded under.
+
+    The key covers the job, the origin server, the final query text and the
+    query parameters, so that a change to any of them is treated as a new load.
+    """
+
+    if isinstance(parameters, str):
+        parameters = [param.strip() for param in parameters.split(",")]
+
+    payload = json.dumps(
+        {
+            "job": job,
+            "origin": origin,
+            "query": query,
+            "parameters": list(parameters) if parameters else [],
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LoadStateStore:
+    """SQLite backed record of the last committed load for each state key."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS load_state ("
+            " state_key TEXT PRIMARY KEY,"
+            " job TEXT,"
+            " digest TEXT NOT NULL,"
+            " chunk_size INTEGER NOT NULL,"
+            " chunk_digests TEXT NOT NULL,"
+            " row_count INTEGER NOT NULL,"
+            " committed_at TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks ("
+            " job TEXT NOT NULL,"
+            " origin TEXT NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " last_full_sync TEXT,"
+            " updated_at TEXT NOT NULL,"
+            " PRIMARY KEY (job, origin))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS lookup_cache ("
+            " cache_key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " updated_at TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS schedule ("
+            " job TEXT NOT NULL,"
+            " day TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL,"
+            " committed_at TEXT NOT NULL,"
+            " PRIMARY KEY (job, day))"
+        )
+        self.connection.commit()
+
+    def last_load(self, key: str) -> LoadState | None:
+        """Return the last committed load for ``key`` or ``None``."""
+
+        row = self.connection.execute(
+            "SELECT digest, chunk_size, chunk_digests, row_count, committed_at"
+            " FROM load_state WHERE state_key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        digest, chunk_size, chunk_digests, row_count, committed_at = row
+        return LoadState(digest, chunk_size, json.loads(chunk_digests), row_count, committed_at)
+
+    def commit(self, key: str, digest: ResultDigest, job: str | None = None) -> None:
+        """Record ``digest`` as the last committed load for ``key``.
+
+        Only call this after every destination write for the load succeeded,
+        otherwise a rerun would wrongly skip the failed statements.
+        """
+
+        committed_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO load_state"
+            " (state_key, job, digest, chunk_size, chunk_digests, row_count, committed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                job,
+                digest.hexdigest(),
+                digest.chunk_size,
+                json.dumps(digest.chunk_digests),
+                digest.row_count,
+                committed_at,
+            ),
+        )
+        self.connection.commit()
+
+    def watermark(self, job: str, origin: str) -> Watermark | None:
+        """Return the last synced watermark for ``job`` and ``origin``."""
+
+        row = self.connection.execute(
+            "SELECT kind, value, last_full_sync, updated_at FROM watermarks WHERE job = ? AND origin = ?",
+            (job, origin),
+        ).fetchone()
+        return Watermark(*row) if row is not None else None
+
+    def commit_watermark(self, job: str, origin: str, kind: str, value: str, full_sync: bool = False) -> None:
+        """Record ``value`` as synced for ``job`` and ``origin``.
+
+        ``full_sync`` marks the sync as a full resync, which resets the clock
+        used to schedule the next periodic resync.
+        """
+
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        previous = self.watermark(job, origin)
+        last_full_sync = now if full_sync or previous is None else previous.last_full_sync
+        self.connection.execute(
+            "INSERT OR REPLACE INTO watermarks (job, origin, kind, value, last_full_sync, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (job, origin, kind, value, last_full_sync, now),
+        )
+        self.connection.commit()
+
+    def cached(self, key: str, max_age: float | None = None) -> object | None:
+        """Return the JSON value cached under ``key`` or ``None``.
+
+        With ``max_age``, a value cached more than that many seconds ago is
+        treated as missing.
+        """
+
+        row = self.connection.execute(
+            "SELECT value, updated_at FROM lookup_cache WHERE cache_key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if max_age is not None:
+            age = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(row[1])
+            if age.total_seconds() > max_age:
+                return None
+        return json.loads(row[0])
+
+    def cache(self, key: str, value: object) -> None:
+        """Cache the JSON-serialisable ``value`` under ``key``."""
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO lookup_cache (cache_key, value, updated_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), datetime.datetime.now(datetime.timezone.utc).isoformat()),
+        )
+        self.connection.commit()
+
+    def fingerprints(self, job: str, first_day: str, last_day: str) -> dict[str, str]:
+        """Return the committed fingerprint of each day of ``job`` between the given ISO days."""
+
+        rows = self.connection.execute(
+            "SELECT day, fingerprint FROM schedule WHERE job = ? AND day BETWEEN ? AND ?",
+            (job, first_day, last_day),
+        )
+        return dict(rows.fetchall())
+
+    def commit_fingerprints(self, job: str, fingerprints: dict[str, str]) -> None:
+        """Record ``fingerprints`` (ISO day to fingerprint) as loaded for ``job``.
+
+        Only call this once the days were written to the destination.
+        """
+
+        committed_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO schedule (job, day, fingerprint, committed_at) VALUES (?, ?, ?, ?)",
+            [(job, day, fingerprint, committed_at) for day, fingerprint in fingerprints.items()],
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
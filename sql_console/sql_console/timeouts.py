@@ -0,0 +1,57 @@
+"""Command line options for query timeouts and job latency budgets.
+
+Every loader accepts ``--query-timeout`` (a limit on each statement) and
+``--latency-budget`` (a limit on the whole run, shared by every connection
+the job opens), so a runaway source query fails the job instead of holding
+up the rest of the batch.  :func:`timeout_params` turns them into the
+:class:`~sql_console.sql_console.SqlWrapper` 'timeout' and 'budget'
+parameters.
+"""
+
+from __future__ import annotations
+
+import argparse
+
+from .sql_console import LatencyBudget
+
+
+def latency_budget(value: str) -> LatencyBudget:
+    """Parse ``--latency-budget``; the budget starts counting when the job does."""
+
+    try:
+        seconds = float(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"invalid latency budget {value!r}; expected seconds") from exc
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError("the latency budget must be positive")
+    return LatencyBudget(seconds)
+
+
+def add_timeout_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the shared timeout options to ``parser``."""
+
+    parser.add_argument(
+        "--query-timeout",
+        dest="query_timeout",
+        type=float,
+        default=None,
+        help="Cancel any single query that runs longer than this many seconds",
+    )
+    parser.add_argument(
+        "--latency-budget",
+        dest="latency_budget",
+        type=latency_budget,
+        default=None,
+        help="Seconds the whole run may spend; every query is limited to what is left of it",
+    )
+
+
+def timeout_params(args: argparse.Namespace) -> dict:
+    """Return the :class:`SqlWrapper` parameters configured by :func:`add_timeout_arguments`."""
+
+    params = {}
+    if args.query_timeout:
+        params["timeout"] = args.query_timeout
+    if args.latency_budget is not None:
+        params["budget"] = args.latency_budget
+    return params
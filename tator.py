@@ -10,11 +10,21 @@ behaviour but is compatible with Python 3.12.
 from __future__ import annotations
 
 import argparse
+import datetime
+import itertools
+import re
 import sys
 from pathlib import Path
-from typing import Iterable
+from typing import Callable, Iterable, Iterator, NamedTuple
 
-from sql_console.sql_console import SqlWrapper
+from sql_console.ledger import JobRun, add_ledger_arguments, run_from_args
+from sql_console.memory import MemoryBudgetExceeded, MemoryMonitor, add_memory_arguments, buffer_rows, monitor_from_args
+from sql_console.profiling import add_profile_arguments, profile_from_args
+from sql_console.partition import PartitionedExtract, PartitionedExtractError
+from sql_console.snapshot import SnapshotReader, SnapshotWriter, cursor_columns
+from sql_console.sql_console import SqlWrapper, SqlWrapperTimeoutError
+from sql_console.state import LoadStateStore, ResultDigest, changed_batches, digest_rows, state_key
+from sql_console.timeouts import add_timeout_arguments, timeout_params
 
 
 def parse_args(argv: Iterable[str] | None = None) -> argparse.Namespace:
@@ -69,11 +79,105 @@ def parse_args(argv: Iterable[str] | None = None) -> argparse.Namespace:
         default=None,
         help='CSV list of parameters to replace placeholders in specified query',
     )
+    parser.add_argument(
+        '--state-file',
+        dest='state_file',
+        type=str,
+        default=None,
+        help='SQLite file recording the digest of the last committed load; unchanged loads are skipped',
+    )
+    parser.add_argument(
+        '--state-chunk-size',
+        dest='state_chunk_size',
+        type=int,
+        default=0,
+        help='Rows per chunk digest; when set, only chunks that changed since the last load are applied',
+    )
+    parser.add_argument(
+        '--partitions',
+        dest='partitions',
+        type=int,
+        default=1,
+        help='Split the source query into this many key ranges extracted in parallel',
+    )
+    parser.add_argument(
+        '--partition-key',
+        dest='partition_key',
+        type=str,
+        default=None,
+        help='Indexed key or date column the source query is partitioned on',
+    )
+    parser.add_argument(
+        '--partition-table',
+        dest='partition_table',
+        type=str,
+        default=None,
+        help='Table holding the partition key, used for MIN/MAX bounds and histogram statistics; required with --partitions',
+    )
+    parser.add_argument(
+        '--partition-histogram',
+        dest='partition_histogram',
+        action='store_true',
+        help='Size partitions from the key column statistics histogram instead of MIN/MAX',
+    )
+    parser.add_argument(
+        '--max-source-connections',
+        dest='max_source_connections',
+        type=int,
+        default=None,
+        help='Cap on concurrent connections to the origin server (defaults to sql_console.hosts.concurrency)',
+    )
+    parser.add_argument(
+        '--full-resync',
+        dest='full_resync',
+        action='store_true',
+        help='Ignore the incremental watermark and re-read every row of an incremental query (through its full= query for Change Tracking)',
+    )
+    parser.add_argument(
+        '--resync-days',
+        dest='resync_days',
+        type=int,
+        default=None,
+        help='Force a full resync of an incremental query when the last one is older than this many days',
+    )
+    parser.add_argument(
+        '--snapshot-out',
+        dest='snapshot_out',
+        type=str,
+        default=None,
+        help='Write the source results to this columnar snapshot file',
+    )
+    parser.add_argument(
+        '--replay',
+        dest='replay',
+        type=str,
+        default=None,
+        help='Load the destination from this snapshot file instead of querying the origin server',
+    )
+    parser.add_argument(
+        '--postgres-driver',
+        dest='postgres_driver',
+        choices=['psycopg2', 'psycopg'],
+        default='psycopg2',
+        help='Driver for the batch database; psycopg (v3) pipelines destination statements',
+    )
+    parser.add_argument(
+        '--pipeline-size',
+        dest='pipeline_size',
+        type=int,
+        default=500,
+        help='Destination statements sent per pipeline with --postgres-driver psycopg',
+    )
+
+    add_timeout_arguments(parser)
+    add_memory_arguments(parser)
+    add_ledger_arguments(parser)
+    add_profile_arguments(parser)
 
     return parser.parse_args(argv)
 
 
-def build_source_connection(args: argparse.Namespace) -> SqlWrapper:
+def source_config(args: argparse.Namespace) -> dict:
     server_config = {
         'ozark': {'server': 'ozark', 'db': 'admiral'},
         'eagle': {'server': 'eagle', 'db': 'tradeking'},
@@ -86,36 +190,254 @@ def build_source_connection(args: argparse.Namespace) -> SqlWrapper:
         sys.exit(1)
 
     config = server_config[args.origin]
-    return SqlWrapper(
-        {
-            'env': args.environment,
-            'method': 'pyodbc',
-            'server': config['server'],
-            'db': config['db'],
-            'debug': True,
-            'format': 'json',
-        }
+    return {
+        'env': args.environment,
+        'method': 'pyodbc',
+        'server': config['server'],
+        'db': config['db'],
+        'debug': True,
+        'format': 'json',
+        'admission': True,
+        **timeout_params(args),
+    }
+
+
+def build_source_connection(args: argparse.Namespace) -> SqlWrapper:
+    return SqlWrapper(source_config(args))
+
+
+FETCH_SIZE = 1000
+
+
+def fetch_source_results(
+    args: argparse.Namespace,
+    script: str,
+    connection: SqlWrapper | None = None,
+    monitor: MemoryMonitor | None = None,
+) -> tuple[Iterator | bool, Callable[[], object] | None]:
+    """Return an iterator over the source rows and a callable returning their cursor description.
+
+    The rows are streamed from the source as the iterator is consumed;
+    ``(False, None)`` means the source query failed.  Partitioned extracts
+    raise :class:`PartitionedExtractError` while iterating instead.
+    """
+
+    serial = args.partitions <= 1
+    if not serial and not args.partition_table:
+        print('tator: warning: --partitions needs --partition-table to size the key ranges, extracting serially')
+        serial = True
+
+    if serial:
+        if connection is None:
+            connection = build_source_connection(args)
+        fetch_size = (lambda: monitor.batch_size(FETCH_SIZE)) if monitor is not None else FETCH_SIZE
+        rows = connection.iter_query({'query': script, 'fetch_size': fetch_size})
+        if rows is False:
+            return False, None
+        return rows, lambda: connection.cursor.description
+
+    if not args.partition_key:
+        print('tator: error: --partition-key is required with --partitions')
+        sys.exit(1)
+
+    if connection is not None:
+        # only needed to plan the incremental sync, the partitions use their own pool
+        connection.close()
+
+    extract = PartitionedExtract(
+        source_config(args),
+        script,
+        args.partition_key,
+        partitions=args.partitions,
+        table=args.partition_table,
+        histogram=args.partition_histogram,
+        max_concurrency=args.max_source_connections,
     )
 
+    def rows() -> Iterator:
+        try:
+            yield from extract.rows()
+        finally:
+            extract.close()
+
+    return rows(), lambda: extract.description
+
+
+def batch_config(args: argparse.Namespace) -> dict:
+    return {
+        'env': args.environment,
+        'method': args.postgres_driver,
+        'server': 'pg' + args.environment,
+        'db': 'batch',
+        'credentials': {'user': args.username, 'password': args.password},
+        'debug': True,
+        'format': 'json',
+        **timeout_params(args),
+    }
+
 
 def build_batch_connection(args: argparse.Namespace) -> SqlWrapper:
-    return SqlWrapper(
-        {
-            'env': args.environment,
-            'method': 'psycopg2',
-            'server': 'pg' + args.environment,
-            'db': 'batch',
-            'credentials': {'user': args.username, 'password': args.password},
-            'debug': True,
-            'format': 'json',
-        }
-    )
+    return SqlWrapper(batch_config(args))
+
+
+INCREMENTAL_DIRECTIVE = re.compile(r'^\s*--\s*tator:incremental\s+(?P<options>.*)$', re.MULTILINE)
+
+# query returning the exclusive upper bound of the current sync, and whether
+# the lower bound (the last synced value) is inclusive
+INCREMENTAL_KINDS = {
+    'rowversion': ("SELECT CONVERT(varchar(18), MIN_ACTIVE_ROWVERSION(), 1)", True),
+    # datetime precision: a 7-digit datetime2 literal does not convert to datetime
+    'timestamp': ("SELECT CONVERT(varchar(23), GETDATE(), 126)", True),
+    'change_tracking': ("SELECT CHANGE_TRACKING_CURRENT_VERSION()", False),
+}
+
+
+CHANGETABLE_SOURCE = re.compile(r'CHANGETABLE\s*\(\s*CHANGES\s+(?P<table>[\w.\[\]]+)', re.IGNORECASE)
+
+
+class IncrementalSpec(NamedTuple):
+    column: str
+    kind: str
+    table: str | None = None
+    full_query: str | None = None
+
+
+class IncrementalSync(NamedTuple):
+    spec: IncrementalSpec
+    lower: str | None
+    upper: str
+    full: bool
 
 
 def load_query(query_filename: str) -> str:
     query_path = Path('sql') / query_filename
     with query_path.open('rt', encoding='utf-8') as f:
-        return f.read().replace('\n', ' ')
+        return INCREMENTAL_DIRECTIVE.sub('', f.read()).replace('\n', ' ')
+
+
+def load_incremental_spec(query_filename: str) -> IncrementalSpec | None:
+    """Return the change-tracking column declared by the query template, if any.
+
+    A template opts into incremental extraction with a directive line such as
+    ``-- tator:incremental column=t.RowVer kind=rowversion`` and places the
+    ``[[CHANGED_SINCE]]`` predicate in its WHERE clause.  Change Tracking
+    templates can also use ``[[LAST_SYNC]]`` as the CHANGETABLE version.
+
+    ``CHANGETABLE(CHANGES ...)`` only returns changes, never the whole table,
+    so a Change Tracking template names a second query file reading the base
+    table with ``full=<file>``; it is run for full syncs: the first one,
+    ``--full-resync``, and whenever the saved version has fallen behind the
+    table's retention (``CHANGE_TRACKING_MIN_VALID_VERSION``).  The tracked
+    table is taken from the CHANGETABLE clause, or from ``table=<table>``.
+    """
+
+    query_path = Path('sql') / query_filename
+    with query_path.open('rt', encoding='utf-8') as f:
+        text = f.read()
+    match = INCREMENTAL_DIRECTIVE.search(text)
+
+    if match is None:
+        return None
+
+    options = dict(option.split('=', 1) for option in match.group('options').split() if '=' in option)
+    kind = options.get('kind', 'rowversion')
+    if 'column' not in options or kind not in INCREMENTAL_KINDS:
+        print('tator: error: incremental directive needs column=<column> and kind=' + '|'.join(INCREMENTAL_KINDS))
+        sys.exit(1)
+
+    table = options.get('table')
+    if kind == 'change_tracking' and table is None:
+        source = CHANGETABLE_SOURCE.search(INCREMENTAL_DIRECTIVE.sub('', text))
+        if source is None:
+            print('tator: error: change_tracking directive needs table=<table> when the query has no CHANGETABLE(CHANGES <table>, ...)')
+            sys.exit(1)
+        table = source.group('table')
+
+    return IncrementalSpec(options['column'], kind, table, options.get('full'))
+
+
+def incremental_job(args: argparse.Namespace) -> str:
+    job = 'tator:' + args.query
+    if args.query_parameters:
+        job += '[' + args.query_parameters + ']'
+    return job
+
+
+def plan_incremental_sync(
+    spec: IncrementalSpec,
+    connection: SqlWrapper,
+    state: LoadStateStore | None,
+    args: argparse.Namespace,
+) -> IncrementalSync | bool:
+    """Return the range of change-tracking values this run should read."""
+
+    rows = connection.query({'query': INCREMENTAL_KINDS[spec.kind][0], 'results': True})
+    if not rows or rows[0][0] is None:
+        print('tator: error: could not read the current ' + spec.kind + ' high-water mark')
+        return False
+    upper = str(rows[0][0])
+
+    if state is None:
+        print('tator: warning: incremental query without --state-file, reading every row')
+        return full_sync(spec, upper)
+
+    watermark = state.watermark(incremental_job(args), args.origin)
+    if watermark is None or watermark.kind != spec.kind or args.full_resync:
+        return full_sync(spec, upper)
+
+    if args.resync_days is not None and watermark.last_full_sync is not None:
+        last_full_sync = datetime.datetime.fromisoformat(watermark.last_full_sync)
+        if datetime.datetime.now(datetime.timezone.utc) - last_full_sync >= datetime.timedelta(days=args.resync_days):
+            print('tator: info: last full resync was ' + watermark.last_full_sync + ', resyncing')
+            return full_sync(spec, upper)
+
+    if spec.kind == 'change_tracking':
+        table = spec.table.replace("'", "''")
+        rows = connection.query({'query': f"SELECT CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('{table}'))", 'results': True})
+        if not rows or rows[0][0] is None:
+            print('tator: error: Change Tracking is not enabled on ' + spec.table)
+            return False
+        if int(watermark.value) < int(rows[0][0]):
+            # the changes since the watermark have been cleaned up, so they cannot be read incrementally
+            print('tator: warning: last synced version ' + watermark.value + ' of ' + spec.table + ' is older than the minimum valid version ' + str(rows[0][0]) + ', resyncing')
+            return full_sync(spec, upper)
+
+    return IncrementalSync(spec, watermark.value, upper, False)
+
+
+def full_sync(spec: IncrementalSpec, upper: str) -> IncrementalSync | bool:
+    if spec.kind == 'change_tracking' and spec.full_query is None:
+        print('tator: error: a full Change Tracking sync needs full=<query file> reading the base table in the incremental directive')
+        return False
+    return IncrementalSync(spec, None, upper, True)
+
+
+def incremental_literal(kind: str, value: str | None) -> str:
+    if value is None:
+        return 'NULL'
+    if kind == 'timestamp':
+        # watermarks saved with 7 fractional digits are cut to datetime precision,
+        # which can only move the inclusive lower bound earlier
+        return "'" + value[:23].replace("'", "''") + "'"
+    return value
+
+
+def apply_incremental(script: str, sync: IncrementalSync) -> str:
+    column = sync.spec.column
+    lower_inclusive = INCREMENTAL_KINDS[sync.spec.kind][1]
+    upper = incremental_literal(sync.spec.kind, sync.upper)
+
+    if lower_inclusive:
+        predicate = f'{column} < {upper}'
+        if sync.lower is not None:
+            predicate = f'{column} >= {incremental_literal(sync.spec.kind, sync.lower)} AND ' + predicate
+    else:
+        predicate = f'{column} <= {upper}'
+        if sync.lower is not None:
+            predicate = f'{column} > {incremental_literal(sync.spec.kind, sync.lower)} AND ' + predicate
+
+    script = script.replace('[[CHANGED_SINCE]]', '(' + predicate + ')')
+    return script.replace('[[LAST_SYNC]]', incremental_literal(sync.spec.kind, sync.lower))
 
 
 def apply_parameters(script: str, args: argparse.Namespace) -> str:
@@ -136,27 +458,263 @@ def apply_parameters(script: str, args: argparse.Namespace) -> str:
 
 def run(argv: Iterable[str] | None = None) -> None:
     args = parse_args(argv)
+    monitor = monitor_from_args('tator', args)
+    job_run = run_from_args('tator:' + str(args.query or args.replay), args, batch_config(args), monitor)
+
+    try:
+        with job_run, profile_from_args('tator', args):
+            load(args, monitor, job_run)
+    except (MemoryBudgetExceeded, SqlWrapperTimeoutError, PartitionedExtractError) as exc:
+        print(str(exc))
+        sys.exit(1)
+    finally:
+        if args.memory_report:
+            monitor.report()
+
+
+def load(args: argparse.Namespace, monitor: MemoryMonitor, job_run: JobRun) -> None:
+    with monitor.stage('connect'):
+        batch = build_batch_connection(args)
+        state = LoadStateStore(args.state_file) if args.state_file else None
 
-    connection = build_source_connection(args)
-    batch = build_batch_connection(args)
+    sync = None
+    with monitor.stage('fetch'):
+        if args.replay:
+            tidal_script, source_rows = load_replay(args)
+        else:
+            tidal_script = apply_parameters(load_query(args.query), args)
 
-    tidal_script = apply_parameters(load_query(args.query), args)
-    print('tidal_to_grafana: info: tidal query: ' + tidal_script)
+            connection = None
+            spec = load_incremental_spec(args.query)
+            if spec is not None:
+                connection = build_source_connection(args)
+                sync = plan_incremental_sync(spec, connection, state, args)
+                if sync is False:
+                    sys.exit(1)
+                if sync.full and spec.full_query is not None:
+                    # the current version was read first, so changes made during the read are synced next time
+                    tidal_script = apply_parameters(load_query(spec.full_query), args)
+                tidal_script = apply_incremental(tidal_script, sync)
+                print('tator: info: ' + ('full' if sync.full else 'incremental') + ' ' + spec.kind + ' sync up to ' + sync.upper)
 
-    tidal_source_results = connection.query({'query': tidal_script, 'results': True})
-    tidal_source_results = [i[0] for i in tidal_source_results]  # tuple to list
+            print('tidal_to_grafana: info: tidal query: ' + tidal_script)
 
-    if tidal_source_results:
+            source_rows, description = fetch_source_results(args, tidal_script, connection, monitor)
+            if source_rows is False:
+                print('tator: error: source query failed')
+                sys.exit(1)
+            if args.snapshot_out:
+                source_rows = record_snapshot(args, tidal_script, source_rows, description)
+
+        source_results, remaining = buffer_rows(source_rows, monitor)
+
+    if remaining is not None:
+        print('tator: warning: over the soft memory limit after ' + str(len(source_results)) + ' rows, streaming the rest of the load')
+        with monitor.stage('stream'):
+            stream(args, batch, itertools.chain(source_results, remaining), state, sync, tidal_script, monitor, job_run)
+        return
+
+    with monitor.stage('transform'):
+        tidal_source_results = [i[0] for i in source_results]  # tuple to list
+        del source_results
+        job_run.add(rows_read=len(tidal_source_results))
+
+        if not tidal_source_results:
+            if sync is not None and not sync.full:
+                print('tator: info: no changes since last sync')
+                commit_watermark(state, sync, args)
+                return
+            print('tidal_to_grafana: error: script returned no INSERT records...')
+            sys.exit(1)
+
+        changed_chunks = None
+        if state is not None:
+            key = state_key('tator:' + args.query, args.origin, tidal_script, args.query_parameters)
+            digest = digest_rows(tidal_source_results, args.state_chunk_size)
+            previous = state.last_load(key)
+            if previous is not None and previous.digest == digest.hexdigest():
+                print('tator: info: source results unchanged since last load at ' + previous.committed_at + ', skipping destination')
+                commit_watermark(state, sync, args)
+                state.close()
+                return
+            changed_chunks = digest.changed_chunks(previous)
+            if args.state_chunk_size:
+                print('tator: info: applying ' + str(len(changed_chunks)) + ' of ' + str(len(digest.chunk_digests)) + ' changed chunks')
+
+        statements = [
+            str(sr)
+            for index, sr in enumerate(tidal_source_results)
+            if sr and (changed_chunks is None or digest.chunk_of(index) in changed_chunks)
+        ]
+        del tidal_source_results
+
+    with monitor.stage('write'):
         print('tidal source results:')
-        for sr in tidal_source_results:
-            if sr:
-                print(str(sr))
-                dest_results = batch.query({'query': str(sr), 'results': True})
-                if dest_results is False:
-                    print('tidal_to_grafana: error: destination query failed: ' + str(sr))
-    else:
+        failures = apply_statements(batch, statements, args, monitor, job_run)
+        job_run.add(rows_written=len(statements) - failures, bytes_written=sum(len(statement) for statement in statements))
+
+    if state is not None:
+        if failures == 0:
+            state.commit(key, digest, job='tator:' + args.query)
+            commit_watermark(state, sync, args)
+        state.close()
+
+
+def stream(
+    args: argparse.Namespace,
+    batch: SqlWrapper,
+    rows: Iterator,
+    state: LoadStateStore | None,
+    sync: IncrementalSync | None,
+    script: str,
+    monitor: MemoryMonitor,
+    job_run: JobRun,
+) -> None:
+    """Load ``rows`` one fetched batch at a time, without collecting them first.
+
+    The digest is computed as the rows go by.  With ``--state-chunk-size``
+    only the chunks that changed since the last load are applied; without it
+    an unchanged load cannot be told apart until its last row, so every
+    statement is applied.
+    """
+
+    key = state_key('tator:' + args.query, args.origin, script, args.query_parameters) if state is not None else None
+    previous = state.last_load(key) if state is not None else None
+    digest = ResultDigest(args.state_chunk_size)
+    if state is not None and not args.state_chunk_size:
+        print('tator: info: streaming without --state-chunk-size, unchanged rows are applied again')
+
+    applied = 0
+    failures = 0
+    print('tidal source results:')
+    for values in changed_batches((row[0] for row in rows), digest, previous, lambda: monitor.batch_size(FETCH_SIZE)):
+        applied += len(values)
+        statements = [str(sr) for sr in values if sr]
+        failed = apply_statements(batch, statements, args, monitor, job_run)
+        failures += failed
+        job_run.add(rows_written=len(statements) - failed, bytes_written=sum(len(statement) for statement in statements))
+    job_run.add(rows_read=digest.row_count)
+
+    if digest.row_count == 0:
+        if sync is not None and not sync.full:
+            print('tator: info: no changes since last sync')
+            commit_watermark(state, sync, args)
+            return
         print('tidal_to_grafana: error: script returned no INSERT records...')
         sys.exit(1)
+    if args.state_chunk_size:
+        print('tator: info: applied ' + str(applied) + ' of ' + str(digest.row_count) + ' rows in changed chunks')
+
+    if state is not None:
+        if failures == 0:
+            state.commit(key, digest, job='tator:' + args.query)
+            commit_watermark(state, sync, args)
+        state.close()
+
+
+def apply_statement(batch: SqlWrapper, statement: str) -> bool:
+    print(statement)
+    dest_results = batch.query({'query': statement, 'results': True})
+    if dest_results is False:
+        print('tidal_to_grafana: error: destination query failed: ' + statement)
+        return False
+    return True
+
+
+def apply_statements(
+    batch: SqlWrapper,
+    statements: list[str],
+    args: argparse.Namespace,
+    monitor: MemoryMonitor | None = None,
+    job_run: JobRun | None = None,
+) -> int:
+    """Run ``statements`` against the batch database and return the number that failed.
+
+    With psycopg 3 the statements are pipelined, ``--pipeline-size`` at a time,
+    each pipeline in its own transaction (smaller once ``monitor`` is over its
+    soft memory limit).  A failed pipeline is rolled back and replayed one
+    statement at a time to report exactly which statements fail.
+    """
+
+    if args.postgres_driver != 'psycopg' or args.pipeline_size <= 1:
+        failures = 0
+        for statement in statements:
+            if monitor is not None:
+                monitor.check()
+            if not apply_statement(batch, statement):
+                failures += 1
+        return failures
+
+    failures = 0
+    start = 0
+    while start < len(statements):
+        size = monitor.batch_size(args.pipeline_size) if monitor is not None else args.pipeline_size
+        chunk = statements[start:start + size]
+        start += size
+        for statement in chunk:
+            print(statement)
+        if batch.query({'query': chunk, 'results': False, 'pipeline': True}) is False:
+            print('tator: info: pipeline failed, replaying ' + str(len(chunk)) + ' statements one at a time')
+            if job_run is not None:
+                job_run.add(retries=1)
+            failures += sum(1 for statement in chunk if not apply_statement(batch, statement))
+    return failures
+
+
+def record_snapshot(
+    args: argparse.Namespace, script: str, rows: Iterable, description: Callable[[], object]
+) -> Iterator:
+    """Pass ``rows`` through, writing them to the --snapshot-out snapshot on the way."""
+
+    metadata = {
+        'job': 'tator',
+        'query_file': args.query,
+        'query': script,
+        'parameters': args.query_parameters,
+        'process_date': args.process_date,
+        'origin': args.origin,
+        'environment': args.environment,
+    }
+    writer = None
+    try:
+        for row in rows:
+            if writer is None:
+                writer = SnapshotWriter(args.snapshot_out, cursor_columns(description(), len(row)), metadata)
+            writer.write((row,))
+            yield row
+        if writer is None:
+            writer = SnapshotWriter(args.snapshot_out, cursor_columns(description(), 1), metadata)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    writer.close()
+    print('tator: info: wrote ' + str(writer.row_count) + ' source rows to snapshot ' + args.snapshot_out)
+
+
+def load_replay(args: argparse.Namespace) -> tuple[str, Iterator]:
+    """Return the query recorded in the --replay snapshot and an iterator over its rows."""
+
+    snapshot = SnapshotReader(args.replay)
+    metadata = snapshot.metadata
+
+    # identify the load by what was snapshotted unless overridden
+    args.query = args.query or metadata.get('query_file')
+    args.origin = args.origin or metadata.get('origin')
+    args.query_parameters = args.query_parameters or metadata.get('parameters')
+    print('tator: info: replaying ' + str(snapshot.row_count) + ' source rows from ' + args.replay + ' taken at ' + str(metadata.get('created_at')))
+
+    def rows() -> Iterator:
+        with snapshot:
+            yield from snapshot
+
+    return metadata.get('query', ''), rows()
+
+
+def commit_watermark(state: LoadStateStore | None, sync: IncrementalSync | None, args: argparse.Namespace) -> None:
+    if state is None or sync is None:
+        return
+    state.commit_watermark(incremental_job(args), args.origin, sync.spec.kind, sync.upper, full_sync=sync.full)
 
 
 if __name__ == '__main__':
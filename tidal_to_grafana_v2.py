@@ -21,10 +21,18 @@ Usage example::
 from __future__ import annotations
 
 import argparse
+import itertools
+from collections.abc import Iterator
 from pathlib import Path
 import sys
 
-from sql_console.sql_console import SqlWrapper
+from sql_console.ledger import JobRun, add_ledger_arguments, run_from_args
+from sql_console.memory import MemoryBudgetExceeded, MemoryMonitor, add_memory_arguments, buffer_rows, monitor_from_args
+from sql_console.profiling import add_profile_arguments, profile_from_args
+from sql_console.rollup import INTERVALS, RollupSpec, RollupStage
+from sql_console.sql_console import SqlWrapper, SqlWrapperTimeoutError
+from sql_console.state import LoadStateStore, ResultDigest, changed_batches, digest_rows, state_key
+from sql_console.timeouts import add_timeout_arguments, timeout_params
 
 
 def parse_args() -> argparse.Namespace:
@@ -88,11 +96,91 @@ def parse_args() -> argparse.Namespace:
         help="CSV list of parameters to replace placeholders in specified query",
     )
 
+    parser.add_argument(
+        "--state-file",
+        dest="state_file",
+        type=str,
+        default=None,
+        help="SQLite file recording the digest of the last committed load; unchanged loads are skipped",
+    )
+
+    parser.add_argument(
+        "--state-chunk-size",
+        dest="state_chunk_size",
+        type=int,
+        default=0,
+        help="Rows per chunk digest; when set, only chunks that changed since the last load are applied",
+    )
+
+    parser.add_argument(
+        "--rollup",
+        dest="rollup",
+        type=str,
+        default=None,
+        help="CSV list of target tables whose newly inserted rows are folded into rollup tables",
+    )
+
+    parser.add_argument(
+        "--rollup-interval",
+        dest="rollup_interval",
+        choices=INTERVALS,
+        default="day",
+        help="Rollup period",
+    )
+
+    parser.add_argument(
+        "--rollup-job-column",
+        dest="rollup_job_column",
+        type=str,
+        default="job",
+        help="Column of the target table identifying the job",
+    )
+
+    parser.add_argument(
+        "--rollup-time-column",
+        dest="rollup_time_column",
+        type=str,
+        default="start_time",
+        help="Timestamp column of the target table used to assign the rollup period",
+    )
+
+    parser.add_argument(
+        "--rollup-duration",
+        dest="rollup_duration",
+        type=str,
+        default="EXTRACT(EPOCH FROM (end_time - start_time))",
+        help="SQL expression over the target table giving the run duration in seconds",
+    )
+
+    parser.add_argument(
+        "--postgres-driver",
+        dest="postgres_driver",
+        choices=["psycopg2", "psycopg"],
+        default="psycopg2",
+        help="Driver for the batch database; psycopg (v3) pipelines destination statements",
+    )
+
+    parser.add_argument(
+        "--pipeline-size",
+        dest="pipeline_size",
+        type=int,
+        default=500,
+        help="Destination statements sent per pipeline with --postgres-driver psycopg",
+    )
+
+    add_timeout_arguments(parser)
+    add_memory_arguments(parser)
+    add_ledger_arguments(parser)
+    add_profile_arguments(parser)
+
     return parser.parse_args()
 
 
-def build_connection(origin: str, env: str) -> SqlWrapper:
-    """Return a :class:`SqlWrapper` configured for ``origin``."""
+def build_connection(origin: str, env: str, timeouts: dict | None = None) -> SqlWrapper:
+    """Return a :class:`SqlWrapper` configured for ``origin``.
+
+    ``timeouts`` holds the 'timeout' and 'budget' parameters, if any.
+    """
 
     match origin:
         case "ozark":
@@ -104,6 +192,8 @@ def build_connection(origin: str, env: str) -> SqlWrapper:
                     "db": "admiral",
                     "debug": True,
                     "format": "json",
+                    "admission": True,
+                    **(timeouts or {}),
                 }
             )
 
@@ -116,6 +206,8 @@ def build_connection(origin: str, env: str) -> SqlWrapper:
                     "db": "tradeking",
                     "debug": True,
                     "format": "json",
+                    "admission": True,
+                    **(timeouts or {}),
                 }
             )
 
@@ -128,6 +220,8 @@ def build_connection(origin: str, env: str) -> SqlWrapper:
                     "db": "fbidb",
                     "debug": True,
                     "format": "json",
+                    "admission": True,
+                    **(timeouts or {}),
                 }
             )
 
@@ -140,6 +234,8 @@ def build_connection(origin: str, env: str) -> SqlWrapper:
                     "db": "worldwide",
                     "debug": True,
                     "format": "json",
+                    "admission": True,
+                    **(timeouts or {}),
                 }
             )
 
@@ -147,22 +243,115 @@ def build_connection(origin: str, env: str) -> SqlWrapper:
             raise ValueError(f"Unknown origin: {origin}")
 
 
+def batch_config(args: argparse.Namespace) -> dict:
+    """Return the :class:`SqlWrapper` parameters of the batch database."""
+
+    return {
+        "env": args.environment,
+        "method": args.postgres_driver,
+        "server": f"pg{args.environment}",
+        "db": "batch",
+        "credentials": {"user": args.username, "password": args.password},
+        "debug": True,
+        "format": "json",
+        **timeout_params(args),
+    }
+
+
+def write_statement(batch: SqlWrapper, statement: str) -> bool:
+    """Run one destination statement."""
+
+    print(statement)
+    dest_results = batch.query({"query": statement, "results": True})
+    if dest_results is False:
+        print(f"tidal_to_grafana: error: destination query failed: {statement}")
+        return False
+    return True
+
+
+def write_statements(
+    batch: SqlWrapper,
+    statements: list[str],
+    args: argparse.Namespace,
+    monitor: MemoryMonitor | None = None,
+    job_run: JobRun | None = None,
+) -> bool:
+    """Run ``statements`` in order, stopping at the first failure.
+
+    With psycopg 3 the statements are pipelined ``--pipeline-size`` at a time
+    (fewer once ``monitor`` is over its soft memory limit), each pipeline in
+    its own transaction.  A failed pipeline is rolled back and replayed one
+    statement at a time up to the failing statement.
+    """
+
+    if args.postgres_driver != "psycopg" or args.pipeline_size <= 1:
+        for statement in statements:
+            if monitor is not None:
+                monitor.check()
+            if not write_statement(batch, statement):
+                return False
+        return True
+
+    start = 0
+    while start < len(statements):
+        size = monitor.batch_size(args.pipeline_size) if monitor is not None else args.pipeline_size
+        chunk = statements[start : start + size]
+        start += size
+        for statement in chunk:
+            print(statement)
+
+        results = batch.query({"query": chunk, "results": True, "pipeline": True})
+        if results is False:
+            print(f"tidal_to_grafana: info: pipeline failed, replaying {len(chunk)} statements one at a time")
+            if job_run is not None:
+                job_run.add(retries=1)
+            if not all(write_statement(batch, statement) for statement in chunk):
+                return False
+
+    return True
+
+
+FETCH_SIZE = 1000
+
+
+def build_rollup(args: argparse.Namespace, batch: SqlWrapper) -> RollupStage | None:
+    """Return the rollup stage configured by ``--rollup``, if any."""
+
+    if not args.rollup:
+        return None
+    return RollupStage(
+        RollupSpec(
+            frozenset(table.strip() for table in args.rollup.split(",") if table.strip()),
+            args.rollup_job_column,
+            args.rollup_time_column,
+            args.rollup_duration,
+            args.rollup_interval,
+        ),
+        batch,
+    )
+
+
 def main() -> int:
     args = parse_args()
+    monitor = monitor_from_args("tidal_to_grafana", args)
+    job_run = run_from_args(f"tidal_to_grafana:{args.query}", args, batch_config(args), monitor)
+
+    try:
+        with job_run, profile_from_args("tidal_to_grafana", args):
+            job_run.exit_code = load(args, monitor, job_run)
+        return job_run.exit_code
+    except (MemoryBudgetExceeded, SqlWrapperTimeoutError) as exc:
+        print(str(exc))
+        return 1
+    finally:
+        if args.memory_report:
+            monitor.report()
 
-    connection = build_connection(args.origin, args.environment)
 
-    batch = SqlWrapper(
-        {
-            "env": args.environment,
-            "method": "psycopg2",
-            "server": f"pg{args.environment}",
-            "db": "batch",
-            "credentials": {"user": args.username, "password": args.password},
-            "debug": True,
-            "format": "json",
-        }
-    )
+def load(args: argparse.Namespace, monitor: MemoryMonitor, job_run: JobRun) -> int:
+    with monitor.stage("connect"):
+        connection = build_connection(args.origin, args.environment, timeout_params(args))
+        batch = SqlWrapper(batch_config(args))
 
     # Parse query parameters into correct format
     params: list[str] | None = None
@@ -184,23 +373,130 @@ def main() -> int:
 
     print(f"tidal_to_grafana: info: tidal query: {tidal_script}")
 
-    tidal_source_results = connection.query({"query": tidal_script, "results": True})
-    tidal_source_results = [i[0] for i in tidal_source_results]  # tuple to list
+    with monitor.stage("fetch"):
+        source_rows = connection.iter_query(
+            {"query": tidal_script, "fetch_size": lambda: monitor.batch_size(FETCH_SIZE)}
+        )
+        if source_rows is False:
+            print("tidal_to_grafana: error: source query failed")
+            return 1
+        source_results, remaining = buffer_rows(source_rows, monitor)
+
+    job = f"tidal_to_grafana:{args.query}"
+    key = state_key(job, args.origin, tidal_script, params)
+    if remaining is not None:
+        print(
+            "tidal_to_grafana: warning: over the soft memory limit after"
+            f" {len(source_results)} rows, streaming the rest of the load"
+        )
+        with monitor.stage("stream"):
+            return stream(args, batch, itertools.chain(source_results, remaining), key, monitor, job_run)
+
+    tidal_source_results = [i[0] for i in source_results]  # tuple to list
+    del source_results
+    job_run.add(rows_read=len(tidal_source_results))
 
     if not tidal_source_results:
         print("tidal_to_grafana: error: script returned no INSERT records...")
         return 1
 
-    print("tidal source results:")
-    for sr in tidal_source_results:
-        if not sr:
+    with monitor.stage("transform"):
+        state = LoadStateStore(args.state_file) if args.state_file else None
+        changed_chunks: set[int] | None = None
+        if state is not None:
+            digest = digest_rows(tidal_source_results, args.state_chunk_size)
+            previous = state.last_load(key)
+            if previous is not None and previous.digest == digest.hexdigest():
+                print(
+                    "tidal_to_grafana: info: source results unchanged since last load"
+                    f" at {previous.committed_at}, skipping destination"
+                )
+                state.close()
+                return 0
+            changed_chunks = digest.changed_chunks(previous)
+            if args.state_chunk_size:
+                print(
+                    f"tidal_to_grafana: info: applying {len(changed_chunks)} of"
+                    f" {len(digest.chunk_digests)} changed chunks"
+                )
+
+        rollup = build_rollup(args, batch)
+        if rollup is not None and not rollup.create():
+            return 1
+
+        statements: list[str] = []
+        for index, sr in enumerate(tidal_source_results):
+            if not sr:
+                return 1
+
+            if changed_chunks is not None and digest.chunk_of(index) not in changed_chunks:
+                continue
+
+            statements.append(rollup.rewrite(str(sr)) if rollup is not None else str(sr))
+        del tidal_source_results
+
+    with monitor.stage("write"):
+        print("tidal source results:")
+        if not write_statements(batch, statements, args, monitor, job_run):
             return 1
 
-        print(str(sr))
-        dest_results = batch.query({"query": str(sr), "results": True})
-        if dest_results is False:
-            print(f"tidal_to_grafana: error: destination query failed: {sr}")
+        job_run.add(rows_written=len(statements), bytes_written=sum(len(statement) for statement in statements))
+
+    if state is not None:
+        state.commit(key, digest, job=job)
+        state.close()
+
+    return 0
+
+
+def stream(
+    args: argparse.Namespace,
+    batch: SqlWrapper,
+    rows: Iterator,
+    key: str,
+    monitor: MemoryMonitor,
+    job_run: JobRun,
+) -> int:
+    """Load ``rows`` one fetched batch at a time, without collecting them first.
+
+    The digest is computed as the rows go by.  With ``--state-chunk-size``
+    only the chunks that changed since the last load are written; without it
+    an unchanged load cannot be told apart until its last row, so every
+    statement is written.
+    """
+
+    state = LoadStateStore(args.state_file) if args.state_file else None
+    previous = state.last_load(key) if state is not None else None
+    digest = ResultDigest(args.state_chunk_size)
+    if state is not None and not args.state_chunk_size:
+        print("tidal_to_grafana: info: streaming without --state-chunk-size, unchanged rows are written again")
+
+    rollup = build_rollup(args, batch)
+    if rollup is not None and not rollup.create():
+        return 1
+
+    print("tidal source results:")
+    for values in changed_batches((row[0] for row in rows), digest, previous, lambda: monitor.batch_size(FETCH_SIZE)):
+        statements = [str(sr) for sr in values]
+        ok = all(values) and write_statements(
+            batch,
+            [rollup.rewrite(statement) for statement in statements] if rollup is not None else statements,
+            args,
+            monitor,
+            job_run,
+        )
+        if not ok:
             return 1
+        job_run.add(rows_written=len(statements), bytes_written=sum(len(statement) for statement in statements))
+    job_run.add(rows_read=digest.row_count)
+
+    if digest.row_count == 0:
+        print("tidal_to_grafana: error: script returned no INSERT records...")
+        return 1
+
+    if state is not None:
+        state.commit(key, digest, job=f"tidal_to_grafana:{args.query}")
+        state.close()
 
     return 0
 